@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+
+# In-process index of data roots (<root>/<group>/<sid>/<sid>_* files) for /send-data.
+# Listings are rebuilt incrementally: a directory is re-read with os.scandir only when
+# its mtime changes (a file or folder was added, removed or renamed inside it), so an
+# unchanged tree costs one stat per directory. Dot-directories (e.g. .vigma) are skipped.
+
+# serialized listings kept per root (one per prefix/group/page combination)
+MAX_RESPONSES = 256
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns
+
+def _scan_dirs(path):
+    with os.scandir(path) as it:
+        return sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir())
+
+def _scan_files(path, sid):
+    with os.scandir(path) as it:
+        return sorted(e.name for e in it if e.name.startswith(sid) and e.is_file())
+
+class DirIndex:
+    def __init__(self):
+        self._roots = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self, root):
+        # root -> {'mtime', 'groups': {group -> {'mtime', 'subjects': {sid -> (mtime, files)}}}, 'responses'}
+        # serialized responses are dropped whenever any listing changed
+        entry = self._roots.get(root)
+        changed = entry is None
+
+        mtime = _mtime(root)
+        if entry is None or entry['mtime'] != mtime:
+            old = entry['groups'] if entry else {}
+            entry = {'mtime': mtime, 'groups': {g: old.get(g) for g in _scan_dirs(root)}}
+            changed = True
+
+        for group, state in entry['groups'].items():
+            group_path = os.path.join(root, group)
+            try:
+                mtime = _mtime(group_path)
+            except OSError:
+                continue
+            if state is None or state['mtime'] != mtime:
+                old = state['subjects'] if state else {}
+                state = {'mtime': mtime, 'subjects': {s: old.get(s) for s in _scan_dirs(group_path)}}
+                entry['groups'][group] = state
+                changed = True
+
+            for sid, listing in state['subjects'].items():
+                sid_path = os.path.join(group_path, sid)
+                try:
+                    mtime = _mtime(sid_path)
+                except OSError:
+                    continue
+                if listing is None or listing[0] != mtime:
+                    state['subjects'][sid] = (mtime, _scan_files(sid_path, sid))
+                    changed = True
+
+        if changed:
+            entry['responses'] = {}
+        self._roots[root] = entry
+
+        return entry
+
+    def listing(self, root, prefix='', group=None, offset=0, limit=None):
+        '''
+        Return (body, etag, total) for the {group: {sid: [files]}} listing of root.
+        prefix filters subject ids, group restricts the listing to one group, and
+        offset/limit page through the (group, sid) pairs in sorted order.
+        total is the number of matching subjects before paging.
+        '''
+        root = os.path.abspath(root)
+        params = (prefix, group, offset, limit)
+
+        with self._lock:
+            entry = self._refresh(root)
+            cached = entry['responses'].get(params)
+            if cached is not None:
+                return cached
+
+            subjects = []
+            for g, state in entry['groups'].items():
+                if state is None or (group is not None and g != group):
+                    continue
+                for sid, listing in state['subjects'].items():
+                    if listing is not None and sid.startswith(prefix):
+                        subjects.append((g, sid, listing[1]))
+
+            total = len(subjects)
+            page = subjects[offset:] if limit is None else subjects[offset:offset + limit]
+
+            tree = {}
+            if group is None and not prefix and offset == 0 and limit is None:
+                # full listings keep empty groups, like the original walk
+                tree = {g: {} for g, state in entry['groups'].items() if state is not None}
+            for g, sid, files in page:
+                tree.setdefault(g, {})[sid] = files
+
+            body = json.dumps(tree, separators=(',', ':'))
+            etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+            if len(entry['responses']) >= MAX_RESPONSES:
+                entry['responses'].clear()
+            entry['responses'][params] = (body, etag, total)
+
+        return body, etag, total
+
+    def clear(self):
+        with self._lock:
+            self._roots.clear()
@@ -0,0 +1,99 @@
+import gzip
+import json
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Response formats of /process_form_data, chosen by the 'format' form field or the Accept header:
+#   records  [{'time': 0, 'm': .., 'l': .., 'u': ..}, ...] per frame (default)
+#   columns  {'time': [...], 'm': [...], ...}, one JSON array per column
+#   msgpack  like columns, but numeric columns are little-endian typed buffers:
+#            {'dtype': '<f4' (or '<i4'), 'shape': [n], 'data': <bytes>} (needs the msgpack package)
+# Streamed responses are newline-delimited JSON (one record per line) in records or columns format.
+
+FORMATS = ('records', 'columns', 'msgpack')
+MIMETYPES = {'records': 'application/json', 'columns': 'application/json', 'msgpack': 'application/msgpack'}
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# bodies smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+def negotiate(request, requested=None):
+    '''
+    Pick the response format from the explicit request field, then the Accept header.
+    msgpack falls back to columns when the package is not installed.
+    '''
+    fmt = requested
+    if fmt is None:
+        # only an explicit msgpack entry counts, not */*
+        accept = [mimetype for mimetype, quality in request.accept_mimetypes if quality > 0]
+        fmt = 'msgpack' if 'application/msgpack' in accept or 'application/x-msgpack' in accept else 'records'
+
+    if fmt not in FORMATS:
+        raise ValueError('format must be one of %s, got %r' % (FORMATS, fmt))
+    if fmt == 'msgpack' and msgpack is None:
+        fmt = 'columns'
+
+    return fmt
+
+def wants_stream(request, requested=None):
+    '''
+    Stream when the request field is set (true/1) or NDJSON is explicitly accepted.
+    '''
+    if requested is not None:
+        return requested in (True, 1, 'true', '1')
+
+    accept = [mimetype for mimetype, quality in request.accept_mimetypes if quality > 0]
+    return NDJSON_MIMETYPE in accept
+
+def encode_frame(df, fmt):
+    if df is None:
+        return None
+    if fmt == 'records':
+        return df.to_dict(orient='records')
+    if fmt == 'columns':
+        return df.to_dict(orient='list')
+
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if values.dtype.kind in 'fiu':
+            dtype = '<f4' if values.dtype.kind == 'f' else '<i4'
+            values = np.ascontiguousarray(values.to_numpy(dtype=dtype))
+            columns[col] = {'dtype': dtype, 'shape': [len(values)], 'data': values.tobytes()}
+        else:
+            columns[col] = values.tolist()
+    return columns
+
+def encode_frames(dict_of_df, fmt):
+    if dict_of_df is None:
+        return None
+    return {key: encode_frame(df, fmt) for key, df in dict_of_df.items()}
+
+def dumps(payload, fmt):
+    if fmt == 'msgpack':
+        return msgpack.packb(payload, use_bin_type=True)
+    # NaN is kept as the NaN literal, like flask.jsonify
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+def ndjson_line(record):
+    return dumps(record, 'records') + b'\n'
+
+def make_body(payload, fmt, accept_encoding=''):
+    '''
+    Serialize payload and gzip it when the client accepts it.
+    Returns (body, headers).
+    '''
+    body = dumps(payload, fmt)
+    headers = {'Content-Type': MIMETYPES[fmt], 'Vary': 'Accept, Accept-Encoding'}
+
+    if 'gzip' in accept_encoding and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+
+    return body, headers
@@ -0,0 +1,32 @@
+import numpy as np
+
+# Ensemble statistics over normalized gait-cycle curves.
+# Curves are stacked into one (trials x points) matrix so every statistic is a
+# single reduction along axis 0 instead of a per-point python loop.
+
+def stack_curves(dict_of_df, col):
+    keys = list(dict_of_df.keys())
+    time = dict_of_df[keys[0]]['time'].to_numpy(dtype=float)
+    matrix = np.vstack([dict_of_df[key][col].to_numpy(dtype=float) for key in keys])
+
+    return keys, time, matrix
+
+def ensemble_stats(matrix, percentiles=None):
+    # mean +/- 1 SD (population SD, same as np.std), median and optional percentile bands
+    m = np.mean(matrix, axis=0)
+    sd = np.std(matrix, axis=0)
+
+    stats = {
+        'm': m,
+        'l': m - sd,
+        'u': m + sd,
+        'sd': sd,
+        'median': np.median(matrix, axis=0),
+    }
+
+    if percentiles:
+        bands = np.percentile(matrix, percentiles, axis=0)
+        for p, band in zip(percentiles, bands):
+            stats['p%g' % p] = band
+
+    return stats
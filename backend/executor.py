@@ -0,0 +1,98 @@
+import contextvars
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# Fans independent per-trial work out to a shared worker pool.
+# VIGMA_EXECUTOR: 'thread' (default), 'process', or 'serial' to run tasks in the
+# calling thread for debugging. VIGMA_WORKERS sets the pool size (default: all cores).
+# CPU-bound numpy work that holds the GIL for long stretches (permutation tests) goes
+# to a forkserver process pool of the same size unless VIGMA_EXECUTOR is 'serial'.
+
+MODES = ('serial', 'thread', 'process')
+
+mode = os.environ.get('VIGMA_EXECUTOR', 'thread')
+workers = int(os.environ.get('VIGMA_WORKERS', os.cpu_count() or 1))
+
+if mode not in MODES:
+    raise ValueError('VIGMA_EXECUTOR must be one of %s, got %r' % (MODES, mode))
+
+_pool = None
+_process_pool = None
+_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                if mode == 'process':
+                    _pool = ProcessPoolExecutor(max_workers=workers)
+                else:
+                    _pool = ThreadPoolExecutor(max_workers=workers)
+    return _pool
+
+def get_process_pool():
+    # started from request threads, so workers come from a forkserver: forking this
+    # multi-threaded process could copy locks held by other threads into the children
+    global _process_pool
+    if _process_pool is None:
+        with _lock:
+            if _process_pool is None:
+                _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    return _process_pool
+
+def _submit(fn, args):
+    if mode == 'thread':
+        # run in a copy of the caller's context, so per-request metrics follow the task
+        return get_pool().submit(contextvars.copy_context().run, fn, *args)
+    return get_pool().submit(fn, *args)
+
+def run_tasks(fn, tasks):
+    '''
+    Call fn(*args) for every args tuple in tasks and return the results in order.
+    '''
+    if mode == 'serial' or workers <= 1 or len(tasks) <= 1:
+        return [fn(*args) for args in tasks]
+
+    futures = [_submit(fn, args) for args in tasks]
+    return [future.result() for future in futures]
+
+def iter_tasks(fn, tasks):
+    '''
+    Like run_tasks, but yield (index, result) pairs as soon as each task finishes.
+    '''
+    if mode == 'serial' or workers <= 1 or len(tasks) <= 1:
+        for i, args in enumerate(tasks):
+            yield i, fn(*args)
+        return
+
+    futures = {_submit(fn, args): i for i, args in enumerate(tasks)}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # the consumer stopped early (e.g. a client disconnected from a stream)
+        for future in futures:
+            future.cancel()
+
+def run_cpu_tasks(fn, tasks):
+    '''
+    Like run_tasks, but always in worker processes (fn and its arguments must pickle).
+    '''
+    if mode == 'serial' or workers <= 1 or len(tasks) <= 1:
+        return [fn(*args) for args in tasks]
+
+    futures = [get_process_pool().submit(fn, *args) for args in tasks]
+    return [future.result() for future in futures]
+
+def shutdown():
+    global _pool, _process_pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+        if _process_pool is not None:
+            _process_pool.shutdown()
+            _process_pool = None
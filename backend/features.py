@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Gait-event features of normalized curves, computed for all curves of a selection
+# at once on the stacked (trials x points) matrix:
+#   l_minima/l_maxima  indices of strict local extrema (argrelextrema with np.less/np.greater, order 1)
+#   g_minima/g_maxima  index of the global minimum/maximum (first one, NaN skipped, like idxmin/idxmax)
+#   min/max, min_time/max_time (% of cycle) and rom (range of motion, max - min)
+
+FEATURES = ('l_minima', 'l_maxima', 'g_minima', 'g_maxima', 'min', 'max', 'min_time', 'max_time', 'rom')
+
+def local_extrema(matrix):
+    # boolean masks of strict local minima and maxima; the end points never qualify
+    inner, left, right = matrix[:, 1:-1], matrix[:, :-2], matrix[:, 2:]
+
+    minima = np.zeros(matrix.shape, dtype=bool)
+    maxima = np.zeros(matrix.shape, dtype=bool)
+    minima[:, 1:-1] = (inner < left) & (inner < right)
+    maxima[:, 1:-1] = (inner > left) & (inner > right)
+
+    return minima, maxima
+
+def _split_rows(mask):
+    # column indices of the True entries of every row
+    rows, cols = np.nonzero(mask)
+    return [c.tolist() for c in np.split(cols, np.searchsorted(rows, np.arange(1, len(mask))))]
+
+def curve_features(matrix, time):
+    '''
+    Features of every row of a (trials x points) matrix sampled at time (% of cycle).
+    Returns one dict per row; rows without values get None for the global features.
+    '''
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    time = np.asarray(time, dtype=float)
+
+    minima, maxima = local_extrema(matrix)
+    l_minima, l_maxima = _split_rows(minima), _split_rows(maxima)
+
+    empty = np.isnan(matrix).all(axis=1)
+    g_minima = np.where(np.isnan(matrix), np.inf, matrix).argmin(axis=1)
+    g_maxima = np.where(np.isnan(matrix), -np.inf, matrix).argmax(axis=1)
+
+    rows = np.arange(len(matrix))
+    mins, maxs = matrix[rows, g_minima], matrix[rows, g_maxima]
+    rom = maxs - mins
+
+    features = []
+    for i in rows:
+        if empty[i]:
+            features.append({'l_minima': [], 'l_maxima': [], 'g_minima': None, 'g_maxima': None,
+                             'min': None, 'max': None, 'min_time': None, 'max_time': None, 'rom': None})
+            continue
+        features.append({'l_minima': l_minima[i], 'l_maxima': l_maxima[i],
+                         'g_minima': int(g_minima[i]), 'g_maxima': int(g_maxima[i]),
+                         'min': float(mins[i]), 'max': float(maxs[i]),
+                         'min_time': float(time[g_minima[i]]), 'max_time': float(time[g_maxima[i]]),
+                         'rom': float(rom[i])})
+
+    return features
+
+def mnmx(values):
+    # local and global extrema of one curve, as df1_mnmx/df2_mnmx of /process_form_data
+    features = curve_features(values, np.arange(len(values)))[0]
+    return {key: features[key] for key in ('l_minima', 'l_maxima', 'g_minima', 'g_maxima')}
+
+def summarize(features):
+    # mean and SD over trials of the scalar features
+    summary = {}
+    for key in ('min', 'max', 'min_time', 'max_time', 'rom'):
+        values = np.array([f[key] for f in features if f[key] is not None], dtype=float)
+        summary[key] = {'mean': float(values.mean()), 'sd': float(values.std())} if len(values) else None
+    return summary
+
+class FeatureCache:
+    # LRU of per-trial feature dicts (small, so bounded by entry count)
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, features):
+        with self._lock:
+            self._entries[key] = features
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
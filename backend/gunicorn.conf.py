@@ -0,0 +1,18 @@
+import os
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+#   VIGMA_BIND            address to listen on (default 0.0.0.0:5000)
+#   VIGMA_SERVER_WORKERS  worker processes (default: number of CPU cores)
+#   VIGMA_SERVER_THREADS  request threads per worker (default 4)
+
+bind = os.environ.get('VIGMA_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('VIGMA_SERVER_WORKERS', os.cpu_count() or 1))
+threads = int(os.environ.get('VIGMA_SERVER_THREADS', 4))
+worker_class = 'gthread'
+
+# import wsgi.py (and run its warm-up) once in the master, then fork the workers
+preload_app = True
+
+# large comparisons and streamed responses can take a while
+timeout = 300
+graceful_timeout = 30
@@ -0,0 +1,158 @@
+import contextvars
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Per-request stage timings and process-wide latency histograms and counters.
+# A request's timings are collected in a context variable, so stages timed in
+# worker threads of the executor (which run tasks in a copy of the caller's
+# context) add up into the request that submitted them. Stage durations are
+# totals over all calls in the request, e.g. 'read' sums the reads of every trial.
+
+# Upper bounds (s) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+_current = contextvars.ContextVar('vigma_request_timings', default=None)
+
+class Timings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        # Server-Timing: read;dur=12.3;desc="24 calls", ..., total;dur=40.1
+        with self._lock:
+            parts = ['%s;dur=%.3f;desc="%d call%s"' % (name, total * 1000, count, '' if count == 1 else 's')
+                     for name, (total, count) in self.stages.items()]
+        parts.append('total;dur=%.3f' % (self.elapsed() * 1000))
+        return ', '.join(parts)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def snapshot(self):
+        # cumulative counts per upper bound, like a Prometheus histogram
+        buckets, total = {}, 0
+        for bound, n in zip(BUCKETS, self.counts):
+            total += n
+            buckets['+Inf' if bound == float('inf') else '%g' % bound] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+class Registry:
+    def __init__(self):
+        self.requests = {}
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, table, name, seconds):
+        with self._lock:
+            hist = table.get(name)
+            if hist is None:
+                hist = table[name] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': {name: hist.snapshot() for name, hist in self.requests.items()},
+                'stages': {name: hist.snapshot() for name, hist in self.stages.items()},
+                'counters': dict(self.counters),
+            }
+
+    def clear(self):
+        with self._lock:
+            self.requests.clear()
+            self.stages.clear()
+            self.counters.clear()
+
+registry = Registry()
+
+def start_request():
+    # returns a token for end_request
+    timings = Timings()
+    return timings, _current.set(timings)
+
+def end_request(endpoint, token):
+    timings = _current.get()
+    _current.reset(token)
+    if timings is None:
+        return None
+
+    registry.observe(registry.requests, endpoint, timings.elapsed())
+    return timings
+
+def current():
+    return _current.get()
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        timings = _current.get()
+        if timings is not None:
+            timings.add(name, seconds)
+        registry.observe(registry.stages, name, seconds)
+
+def count(name, n=1):
+    registry.inc(name, n)
+
+# Opt-in profiling: with VIGMA_PROFILE_DIR set, every request is run under cProfile
+# and the stats of those slower than VIGMA_PROFILE_MS (default 1000) are dumped as
+# <dir>/<endpoint>-<unix ms>.prof (view with snakeviz or python -m pstats).
+profile_dir = os.environ.get('VIGMA_PROFILE_DIR')
+profile_ms = float(os.environ.get('VIGMA_PROFILE_MS', 1000))
+
+def start_profile():
+    if not profile_dir:
+        return None
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is active in this thread
+        return None
+    return profiler
+
+def end_profile(profiler, endpoint, seconds):
+    if profiler is None:
+        return None
+
+    profiler.disable()
+    if seconds * 1000 < profile_ms:
+        return None
+
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, '%s-%d.prof' % (endpoint, int(time.time() * 1000)))
+    profiler.dump_stats(path)
+    count('profiles_written')
+
+    return path
@@ -0,0 +1,184 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Outlier scores of the trials of a group against the group's normalized curves,
+# computed on the stacked (trials x points) matrix:
+#   knn          mean RMS distance to the k nearest other trials
+#   depth        1 - integrated (Fraiman-Muniz) functional depth: how often a curve lies
+#                in the tails of the group, averaged over the cycle
+#   mahalanobis  Mahalanobis distance in the principal components that explain 95% of
+#                the variance (100 points are more than a group has trials)
+# Scores are also returned as robust z-scores (median/MAD), which flag outliers
+# above a cutoff whatever the method.
+
+METHODS = ('knn', 'depth', 'mahalanobis')
+
+def fill_missing(matrix):
+    # linear interpolation of missing points along each curve, so a trial's row does not
+    # depend on the other trials; rows without values stay NaN
+    matrix = np.array(matrix, dtype=float)
+    x = np.arange(matrix.shape[1])
+    for i in np.nonzero(np.isnan(matrix).any(axis=1))[0]:
+        ok = ~np.isnan(matrix[i])
+        if ok.any():
+            matrix[i] = np.interp(x, x[ok], matrix[i, ok])
+    return matrix
+
+def pairwise_distances(a, b):
+    '''
+    RMS distances between the rows of a and b (same units as the curves).
+    '''
+    sq = (a ** 2).sum(axis=1)[:, None] + (b ** 2).sum(axis=1)[None, :] - 2 * a @ b.T
+    return np.sqrt(np.maximum(sq, 0) / a.shape[1])
+
+def knn_k(n, k):
+    # the k used for n trials: at most the n - 1 other trials
+    return min(k, n - 1)
+
+def knn_scores(distances, k):
+    # mean distance of every trial to its k nearest others (the diagonal is itself)
+    k = knn_k(len(distances), k)
+    nearest = np.partition(distances + np.diag(np.full(len(distances), np.inf)), k - 1, axis=1)[:, :k]
+    return nearest.mean(axis=1)
+
+def depth_scores(matrix):
+    n = len(matrix)
+    # empirical CDF of every value at its point: rank / n
+    ranks = matrix.argsort(axis=0).argsort(axis=0) + 1
+    depth = 1 - np.abs(0.5 - ranks / n)
+    return 1 - depth.mean(axis=1)
+
+def mahalanobis_scores(matrix, variance=0.95):
+    centered = matrix - matrix.mean(axis=0)
+    u, s, _ = np.linalg.svd(centered, full_matrices=False)
+    if s[0] == 0:
+        return np.zeros(len(matrix))
+
+    explained = np.cumsum(s ** 2) / np.sum(s ** 2)
+    keep = min(int(np.searchsorted(explained, variance)) + 1, int(np.sum(s > s[0] * 1e-10)))
+
+    # component scores are u * s and their variances s**2 / (n - 1)
+    return np.sqrt((len(matrix) - 1) * (u[:, :keep] ** 2).sum(axis=1))
+
+def robust_z(scores):
+    median = np.median(scores)
+    mad = 1.4826 * np.median(np.abs(scores - median))
+    if mad == 0:
+        return np.zeros(len(scores))
+    return (scores - median) / mad
+
+class TrialPool:
+    # Curves of every trial seen for one column/limb/cycle and their pairwise distances.
+    # Trials added later only need their distances to the pool, so growing a selection
+    # costs O(new x pool) instead of a full recomputation
+    def __init__(self):
+        self.index = {}
+        self.curves = None
+        self.distances = np.empty((0, 0))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def missing(self, keys):
+        return [key for key in keys if key not in self.index]
+
+    def add(self, keys, matrix):
+        new = [i for i, key in enumerate(keys) if key not in self.index]
+        if not new:
+            return 0
+
+        matrix = matrix[new]
+        if self.curves is None:
+            self.curves = np.empty((0, matrix.shape[1]))
+        cross = pairwise_distances(matrix, self.curves)
+        within = pairwise_distances(matrix, matrix)
+
+        n = len(self.curves)
+        distances = np.empty((n + len(new), n + len(new)))
+        distances[:n, :n] = self.distances
+        distances[n:, :n] = cross
+        distances[:n, n:] = cross.T
+        distances[n:, n:] = within
+        np.fill_diagonal(distances[n:, n:], 0)
+
+        for j, i in enumerate(new):
+            self.index[keys[i]] = n + j
+        self.curves = np.vstack([self.curves, matrix])
+        self.distances = distances
+        return len(new)
+
+    def select(self, keys):
+        rows = [self.index[key] for key in keys]
+        if not rows:
+            return np.empty((0, 0)), np.empty((0, 0))
+        return self.curves[rows], self.distances[np.ix_(rows, rows)]
+
+class OutlierCache:
+    # TrialPools per (column, limb, cycle), at most max_pools of them with up to max_trials
+    # trials each, or as many as the selection when it is larger (a full pool starts over),
+    # and an LRU of computed scores per selection
+    def __init__(self, max_pools=8, max_trials=2000, max_scores=256):
+        self.max_pools = max_pools
+        self.max_trials = max_trials
+        self.max_scores = max_scores
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+        self._pools = OrderedDict()
+        self._scores = OrderedDict()
+        self.lock = threading.RLock()
+
+    def pool(self, key, trials):
+        # the pool of key, emptied when adding the missing trials would exceed max_trials (or
+        # the selection's size), so a larger selection still stays in its pool
+        with self.lock:
+            pool = self._pools.get(key)
+            if pool is None or len(pool) + len(pool.missing(trials)) > max(self.max_trials, len(trials)):
+                pool = self._pools[key] = TrialPool()
+            self._pools.move_to_end(key)
+            while len(self._pools) > self.max_pools:
+                self._pools.popitem(last=False)
+            return pool
+
+    def get_scores(self, key):
+        with self.lock:
+            entry = self._scores.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._scores.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put_scores(self, key, scores):
+        with self.lock:
+            self._scores[key] = scores
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.max_scores:
+                self._scores.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'pools': len(self._pools), 'trials': sum(len(p) for p in self._pools.values()),
+                    'scores': len(self._scores), 'hits': self.hits, 'misses': self.misses, 'added': self.added}
+
+def score_trials(curves, distances, method='knn', k=5):
+    '''
+    Outlier scores (higher is more unusual) of the rows of curves; distances are their
+    pairwise RMS distances (only used by knn).
+    '''
+    if len(curves) < 3:
+        raise ValueError('outlier scores need at least 3 trials, got %d' % len(curves))
+
+    if method == 'knn':
+        return knn_scores(distances, k)
+    elif method == 'depth':
+        return depth_scores(curves)
+    elif method == 'mahalanobis':
+        return mahalanobis_scores(curves)
+    raise ValueError('method must be one of %s, got %r' % (list(METHODS), method))
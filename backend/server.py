@@ -1,270 +1,373 @@
-from flask import Flask, jsonify, request, Response, send_file, render_template
+from flask import Flask, jsonify, request, Response, send_file, render_template, abort, g, stream_with_context
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
 import os
-from scipy.interpolate import interp1d
-from scipy.signal import argrelextrema
-from sklearn.impute import KNNImputer
-import json
+import sys
+
+# The VIGMA python library (../notebooks) provides the shared storage and processing modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+
+from trial_store import load_table
+from metadata import get_step
+from cycle_store import get_curves, trim_cycle
+from resample import resample_frame
+from imputation import METHODS as IMPUTE_METHODS
+from spatiotemporal import STP_COLUMNS, get_stp
+from ensemble import stack_curves, ensemble_stats
+from curve_cache import CurveCache, curve_key
+from executor import iter_tasks
+from features import curve_features, mnmx, summarize, FeatureCache
+from spm import compare_curves
+from outliers import METHODS as OUTLIER_METHODS, OutlierCache, fill_missing, knn_k, score_trials, robust_z
+from dir_index import DirIndex
+from encoding import negotiate, wants_stream, encode_frame, encode_frames, make_body, ndjson_line, NDJSON_MIMETYPE
+import metrics
 
 app = Flask(__name__)
 CORS(app)
 
-@app.route('/send-data', methods=['POST'])
+# Normalized curves per (file, column, cycle); budget in MB via VIGMA_CURVE_CACHE_MB
+curve_cache = CurveCache(int(os.environ.get('VIGMA_CURVE_CACHE_MB', 256)) * 1024 * 1024)
+
+# Imputation of joint angles for STP: knn (default), local (windowed KNN) or gap; via VIGMA_IMPUTE
+impute_method = os.environ.get('VIGMA_IMPUTE', 'knn')
+if impute_method not in IMPUTE_METHODS:
+    raise ValueError('VIGMA_IMPUTE must be one of %s, got %r' % (list(IMPUTE_METHODS), impute_method))
+
+# Gait-event features per trial (and per ensemble); number of entries via VIGMA_FEATURE_CACHE
+feature_cache = FeatureCache(int(os.environ.get('VIGMA_FEATURE_CACHE', 100000)))
+
+# Curves and pairwise distances of the trials scored by /outliers, per column; trials per
+# pool via VIGMA_OUTLIER_TRIALS
+outlier_cache = OutlierCache(max_trials=int(os.environ.get('VIGMA_OUTLIER_TRIALS', 2000)))
+
+# Largest number of label permutations /compare runs per request
+max_permutations = int(os.environ.get('VIGMA_MAX_PERMUTATIONS', 10000))
+
+# Listings served by /send-data, refreshed from directory mtimes
+dir_index = DirIndex()
+
+# Stage timings of every request go out in a Server-Timing header and into the
+# histograms served by /metrics; VIGMA_PROFILE_DIR turns on cProfile dumps of slow requests
+@app.before_request
+def start_timing():
+    g.metrics_token = metrics.start_request()[1]
+    g.profiler = metrics.start_profile()
+
+@app.after_request
+def add_server_timing(response):
+    timings = metrics.current()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.header()
+        response.headers['Timing-Allow-Origin'] = '*'
+    return response
+
+@app.teardown_request
+def end_timing(exc):
+    token = g.pop('metrics_token', None)
+    if token is None:
+        return
+    endpoint = request.endpoint or 'unmatched'
+    timings = metrics.end_request(endpoint, token)
+    metrics.end_profile(g.pop('profiler', None), endpoint, timings.elapsed())
+
+@app.route('/send-data', methods=['GET', 'POST'])
 def receive_data():
-    # Get folder location from the frontend
+    # Get folder location from the frontend (JSON body, or query string for GET)
 
-    data = request.json
+    data = request.json if request.method == 'POST' else request.args
     folder_location =   data.get('fileLocation')        # data.get('fileLocation')
     
     if folder_location and os.path.exists(folder_location):
-        # List all files inside the folder and its subfolders
-        file_list = []
-
-        folder_files = {}
-                # Iterate through the folders
-        for entry in os.listdir(folder_location):
-            # print("Entry:", entry)
-            full_path = os.path.join(folder_location, entry)
-            if os.path.isdir(full_path):
-                # print("Full Path:", full_path)
-                folder_files[entry] = {}
-                for sub_entry in os.listdir(full_path):
-                    sub_full_path = os.path.join(full_path, sub_entry)
-                    if os.path.isdir(sub_full_path):
-                        folder_files[entry][sub_entry] = []  # Initialize the list for this subfolder
-                        for file in os.listdir(sub_full_path):
-                            if file.startswith(sub_entry):  # Check if file name starts with subfolder name
-                                file_path = os.path.join(sub_full_path, file)
-                                if os.path.isfile(file_path):  # Make sure it's a file
-                                    # Add the file name to the list corresponding to this subfolder
-                                    folder_files[entry][sub_entry].append(file)
-
-        # Convert the dictionary to JSON format
-        json_output = json.dumps(folder_files, indent=4)
-        # print("JSON Output",json_output)
-
-        # Return the list of files as JSON
-        return json_output
+        try:
+            offset = int(data.get('offset') or 0)
+            limit = int(data['limit']) if data.get('limit') is not None else None
+        except (TypeError, ValueError):
+            abort(400, 'offset and limit must be integers')
+        if offset < 0 or (limit is not None and limit < 0):
+            abort(400, 'offset and limit must not be negative')
+
+        # {group: {sid: [files]}}, optionally filtered by subject prefix/group and paged
+        with metrics.stage('listing'):
+            body, etag, total = dir_index.listing(folder_location,
+                                                  prefix=data.get('prefix') or '',
+                                                  group=data.get('group'),
+                                                  offset=offset,
+                                                  limit=limit)
+
+        # 304 Not Modified when the client already holds this listing
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['X-Total-Count'] = str(total)
+        response.headers['Access-Control-Expose-Headers'] = 'ETag, X-Total-Count'
+
+        return response
     else:
         # Return an empty JSON array if folder doesn't exist
         print("Folder doesn't exist")
         return jsonify([])
 
 
-def extract_stp(filepath, sid, trial):
-
-    def knn_impute(data_type = 'jnt', **kwargs):
-        df = kwargs['dataframe']
-        df.columns = df.columns.str.strip()
-
-        if('' in df.columns):
-            df = df.drop(columns=[''])
-
-        columns = ['time', '#frame']
-        existing_columns_to_drop = [col for col in columns if col in df.columns]
+def iter_stp_params(file_location):
+    # one batch per subject: step table, segment lengths and <sid>sptmp.csv are read once.
+    # Yields (positions in file_location, DataFrame of their rows) as each subject finishes
+    subjects = {}
+    for position, file in enumerate(file_location):
+        sid = file.split('/')[-1].split('_')[0]
+        trial = int(file.split('/')[-1].split('_')[1])
+        group_dir = os.path.abspath(os.path.join(file, "../../"))
+        subjects.setdefault((group_dir, sid), []).append((position, trial))
 
-        df_knn = df.drop(columns=existing_columns_to_drop)
+    entries = list(subjects.values())
+    tasks = [(group_dir, sid, [trial for _, trial in trials], impute_method) for (group_dir, sid), trials in subjects.items()]
+    with metrics.stage('stp'):
+        for j, df in iter_tasks(get_stp, tasks):
+            yield [position for position, _ in entries[j]], df
+    metrics.count('stp_subjects', len(tasks))
 
-        knn_imputer = KNNImputer(n_neighbors=5, weights='uniform')
+def get_stp_params(file_location):
+    stpParams = [None] * len(file_location)
+    for positions, df in iter_stp_params(file_location):
+        for position, row in zip(positions, df.itertuples(index=False)):
+            stpParams[position] = list(row)
 
-        df_knn_imputed = pd.DataFrame(
-            knn_imputer.fit_transform(df_knn), columns=df_knn.columns)
+    return pd.DataFrame(stpParams, columns=STP_COLUMNS)
 
-        for col in columns:
-            if col in df.columns:
-                df_knn_imputed[col] = df[col]
+def normalize_trial(file, step_file, trial_num, patient_id, col, cycle):
+    min_points = 100
 
-        return df_knn_imputed
-    
-    jnts = pd.read_csv(filepath + "_jnt.csv")
-    jnts = knn_impute(dataframe = jnts, data_type='jnt')
-    # grfs = pd.read_csv(filepath + "_grf.csv")
+    with metrics.stage('read'):
+        data = load_table(file, ['time', col])
+    metrics.count('file_reads')
 
-    parent_dir = os.path.abspath(os.path.join(filepath, "../../"))
-    demographic_file_path = os.path.join(parent_dir, "demographic.csv")
-    dem = pd.read_csv(demographic_file_path)
+    with metrics.stage('trim'):
+        data_step = get_step(step_file, patient_id, trial_num)
 
-    directory = os.path.dirname(filepath)
-    sts = pd.read_csv(directory + "/" + sid + "step.csv")
+        data_trimmed = trim_cycle(data, data_step, cycle)
 
-    jnts.columns = jnts.columns.str.strip()
-    # grfs.columns = grfs.columns.str.strip()
-    dem.columns = dem.columns.str.strip()
+    with metrics.stage('interpolate'):
+        return resample_frame(data_trimmed, min_points)
 
-    thigh = dem[dem['id'] == sid]['thigh'].values[0]
-    shank = dem[dem['id'] == sid]['shank'].values[0]
+def trial_task(file_location, file, col, cycle):
+    patient_id = file.split('/')[-1].split('_')[0]
+    trial_num = file.split('/')[-1].split('_')[1]
+    folder = file.split('/')[-3]
 
+    folder_location = file_location + '/' + folder
+    step_file = "%s/%s/%sstep.csv" % (folder_location, patient_id, patient_id)
 
-    first_step = sts[sts['trial'] == trial].footing.values[0]
-    trials = list(sts['trial'])
+    return patient_id + '_' + trial_num, (file, step_file, trial_num, patient_id, col, cycle)
 
-    trial_index = trials.index(trial)
+def iter_curves(tasks):
+    # Yield (task index, curve) from the curve cache, then from the materialized cycle
+    # store (python cycle_store.py <root>), then as the executor finishes the rest
+    missing = []
 
-    TDs = sts.filter(like='touch').values[trial_index]
-    LOs = sts.filter(like='off').values[trial_index]
+    with metrics.stage('curve_cache'):
+        cached = []
+        for i, task in enumerate(tasks):
+            key = curve_key(task[0], task[1], task[4], task[5])
+            curve = curve_cache.get(key)
+            if curve is None:
+                missing.append((i, key))
+            else:
+                cached.append((i, curve))
+    for i, curve in cached:
+        yield i, curve
+
+    with metrics.stage('cycle_store'):
+        stored = get_curves([(tasks[i][0], tasks[i][1], tasks[i][4], tasks[i][5]) for i, _ in missing])
+    metrics.count('cycle_store_curves', sum(curve is not None for curve in stored))
+    for (i, key), curve in zip(missing, stored):
+        if curve is not None:
+            yield i, pd.DataFrame({'time': np.linspace(0, 100, len(curve)), tasks[i][4]: curve})
+    missing = [(i, key) for (i, key), curve in zip(missing, stored) if curve is None]
+
+    # wall time of the per-trial work; read/trim/interpolate are its totals over all trials
+    with metrics.stage('normalize'):
+        for j, interpolated_data in iter_tasks(normalize_trial, [tasks[i] for i, _ in missing]):
+            i, key = missing[j]
+            curve_cache.put(key, interpolated_data)
+            yield i, interpolated_data
+    metrics.count('computed_curves', len(missing))
+
+def normalize_trials(tasks):
+    results = [None] * len(tasks)
+    for i, curve in iter_curves(tasks):
+        results[i] = curve
+
+    return results
+
+def plan_groups(file_location, groups):
+    # groups: list of (data_files, col, limb, cycle). Trials of every group (and both
+    # sides of bilateral columns) are normalized in one batch of tasks; a group's plan
+    # lists (column, [(key, task index), ...]) per side
+    tasks = []
+    plans = []
+
+    for data_files, col, limb, cycle in groups:
+        if(col=='AP' or col=='ML' or col=='VT' or col=='foot' or col=='shank' or col=='thigh'):
+            grf = col=='AP' or col=='ML' or col=='VT'
+            cols = ['L-%s'%col if grf else 'L%s'%col, 'R-%s'%col if grf else 'R%s'%col]
+        else:
+            cols = [col]
 
-    timeswing1 = LOs[1] - TDs[1]
-    timeswing2 = LOs[0] - TDs[0]
-    timegait1 = TDs[3] - TDs[1]
-    timegait2 = TDs[2] - TDs[0]
+        plan = []
+        for c in cols:
+            keys = []
+            for file in data_files:
+                key, task = trial_task(file_location, file, c, cycle)
+                keys.append((key, len(tasks)))
+                tasks.append(task)
+            plan.append((c, keys))
+        plans.append(plan)
 
-    timeRswing = timeswing1 if first_step == 'L' else timeswing2
-    timeLswing = timeswing2 if first_step == 'L' else timeswing1
-    timeRgait = timegait1 if first_step == 'L' else timegait2
-    timeLgait = timegait2 if first_step == 'L' else timegait1
+    return tasks, plans
 
-    Rshank = jnts.Rshank.values/180*np.pi
-    Lshank = jnts.Lshank.values/180*np.pi
-    Rthigh = jnts.Rthigh.values/180*np.pi
-    Lthigh = jnts.Lthigh.values/180*np.pi
-    hipx = jnts.hipx.values
+def trial_curve(col, limb, plan, sides):
+    # the curve of one trial from its normalized sides
+    if(len(sides) == 1):
+        return sides[0]
 
-    # Nan values in hipx
-    # if(type(hipx[0]) == str):
-    #     hipx = np.array([float(value.strip()) if value.strip().lower() != 'nan' else np.nan for value in hipx])
-    
+    elif(limb == 'Agg'):
+        (col_L, _), (col_R, _) = plan
 
-    TD1 = int(round(TDs[0]*120))
-    TD2 = int(round(TDs[1]*120))
-    TD3 = int(round(TDs[2]*120))
+        # both sides are already 100-point curves, so the sum needs no resampling
+        df = pd.DataFrame()
+        df['time'] = sides[0]['time'].values
+        df['%s'%col] = sides[0][col_L].values + sides[1][col_R].values
 
-    if(first_step == 'R'):
-        RstepLength = -np.cos(Rthigh[TD1])*thigh - np.cos(Rshank[TD1])*shank + np.cos(Lthigh[TD1])*thigh + np.cos(Lshank[TD1])*shank
-        LstepLength =  np.cos(Rthigh[TD2])*thigh + np.cos(Rshank[TD2])*shank - np.cos(Lthigh[TD2])*thigh - np.cos(Lshank[TD2])*shank
+        return df
 
+    elif(limb == 'L'):
+        return sides[0]
     else:
-        RstepLength = -np.cos(Rthigh[TD2])*thigh - np.cos(Rshank[TD2])*shank + np.cos(Lthigh[TD2])*thigh + np.cos(Lshank[TD2])*shank
-        LstepLength =  np.cos(Rthigh[TD1])*thigh + np.cos(Rshank[TD1])*shank - np.cos(Lthigh[TD1])*thigh - np.cos(Lshank[TD1])*shank
-
-    GaitSpeed = np.mean((np.diff(hipx)*120)[TD1-1:TD3])
-
-    return RstepLength, LstepLength, timeRswing, timeLswing, timeRgait, timeLgait, GaitSpeed
-
-def get_stp_params(file_location):
-    stpParams = []
-    for file in file_location:
-        sid = file.split('/')[-1].split('_')[0]
-        trial = int(file.split('/')[-1].split('_')[1])
-        RstepLength, LstepLength, timeRswing, timeLswing, timeRgait, timeLgait, GaitSpeed = extract_stp(file, sid, trial)
-        stpParams.append([sid, trial, RstepLength, LstepLength, timeRswing, timeLswing, timeRgait, timeLgait, GaitSpeed])
-
-    return pd.DataFrame(stpParams, columns=['sid', 'trial', 'RstepLength', 'LstepLength', 'timeRswing', 'timeLswing', 'timeRgait', 'timeLgait', 'GaitSpeed'])
-
-def interpolate_data(df, min_points):
-    indices = np.arange(len(df))
-    interpolated_data = pd.DataFrame()
-
-    cols = df.columns.tolist()
-
-    for col in cols:
-        if(col != 'time'):
-            interpolation_function = interp1d(indices, df[col], kind='linear')
-            interpolated_indices = np.linspace(0, len(df) - 1, min_points)
-            interpolated_data[col] = interpolation_function(interpolated_indices)
-
-    t = np.linspace(0, 100, len(interpolated_data))
-    interpolated_data['time'] = t
-
-    cols = interpolated_data.columns.tolist()
-    cols = cols[-1:] + cols[:-1]
-    interpolated_data = interpolated_data[cols]
-    
-    return interpolated_data
+        return sides[1]
+
+def iter_normalized_groups(groups, tasks, plans):
+    # Yield (group index, key, curve) as soon as every side of a trial is normalized
+    owners = {}
+    for g, plan in enumerate(plans):
+        for side, (_, keys) in enumerate(plan):
+            for key, i in keys:
+                owners.setdefault(i, []).append((g, key, side))
+
+    sides = {}
+    for i, curve in iter_curves(tasks):
+        for g, key, side in owners[i]:
+            done = sides.setdefault((g, key), {})
+            first = len(done) < len(plans[g])
+            done[side] = curve
+            if first and len(done) == len(plans[g]):
+                _, col, limb, _ = groups[g]
+                yield g, key, trial_curve(col, limb, plans[g], [done[s] for s in range(len(plans[g]))])
+
+def group_keys(plan):
+    # trial keys of a group in selection order
+    return list(dict.fromkeys(key for key, _ in plan[0][1]))
+
+def get_normalized_groups(file_location, groups):
+    tasks, plans = plan_groups(file_location, groups)
+
+    curves = [{} for _ in groups]
+    for g, key, curve in iter_normalized_groups(groups, tasks, plans):
+        curves[g][key] = curve
+
+    # back in selection order, so the ensembles do not depend on completion order
+    return [{key: curves[g][key] for key in group_keys(plan)} for g, plan in enumerate(plans)]
 
 def get_normalized_data(file_location, data_files, col, limb, cycle):
+    return get_normalized_groups(file_location, [(data_files, col, limb, cycle)])[0]
 
-    def normalize_data(file_location, data_files, col, cycle):
-        min_points = 100
-        dict_ = {}
-
-        for file in data_files:
-            patient_id = file.split('/')[-1].split('_')[0]
-            trial_num = file.split('/')[-1].split('_')[1]
-            folder = file.split('/')[-3]
-
-            folder_location = file_location + '/' + folder
-            data = pd.read_csv(file)
-            data = data[['time', col]]
-            
-            data_step = pd.read_csv("%s/%s/%sstep.csv" % (folder_location,patient_id, patient_id))
-            data_step = data_step[(data_step['trial'] == int(trial_num)) & (data_step['subject'] == patient_id)]
-            
-            if(data_step['footing'].values[0] == 'L'):
-                if(cycle == 'L'): data_trimmed = data[(data['time'] >= data_step['touch down'].values[0]) & (data['time'] <= data_step['touch down.2'].values[0])]
-                else: data_trimmed = data[(data['time'] >= data_step['touch down.1'].values[0]) & (data['time'] <= data_step['touch down.3'].values[0])]
-            else:
-                if(cycle == 'L'): data_trimmed = data[(data['time'] >= data_step['touch down.1'].values[0]) & (data['time'] <= data_step['touch down.3'].values[0])]
-                else: data_trimmed = data[(data['time'] >= data_step['touch down'].values[0]) & (data['time'] <= data_step['touch down.2'].values[0])]
-            
-            interpolated_data = interpolate_data(data_trimmed, min_points)
-            dict_[patient_id + '_' + trial_num] = interpolated_data
-
-        return dict_
-    
-    if(col=='AP' or col=='ML' or col=='VT' or col=='foot' or col=='shank' or col=='thigh'):
-        if(col=='AP' or col=='ML' or col=='VT'): grf = True
-        else: grf = False
-        
-        dict_L = normalize_data(file_location, data_files, 'L-%s'%col if grf else 'L%s'%col, cycle)
-        dict_R = normalize_data(file_location, data_files, 'R-%s'%col if grf else 'R%s'%col, cycle)
-
-        if(limb == 'Agg'):
-            dict_agg = {}
-
-            for key in dict_L.keys():
-                dict_L_values = dict_L[key]['L-%s'%col if grf else 'L%s'%col].values
-                dict_R_values = dict_R[key]['R-%s'%col if grf else 'R%s'%col].values
-
-                df = pd.DataFrame()
-                df['time'] = dict_L[key]['time'].values
-                df['%s'%col] = [x + y for x, y in zip(dict_L_values, dict_R_values)]
-                df = interpolate_data(df, 100)
-
-                dict_agg[key] = df
-
-            return dict_agg
-        
-        elif(limb == 'L'):
-            return dict_L
-        else:
-            return dict_R
-        
-    else:
-        dict_ = normalize_data(file_location, data_files, col, cycle)
-        return dict_
-
-def get_ensembled_data(dict_of_df, col):
-    
-    def mean_sd(data):
-        m = np.mean(data)
-        sd = np.std(data)
-        return m, m-sd, m+sd
+def get_ensembled_data(dict_of_df, col, percentiles=None):
+    with metrics.stage('ensemble'):
+        _, time, matrix = stack_curves(dict_of_df, col)
+        stats = ensemble_stats(matrix, percentiles)
 
     df = pd.DataFrame()
-    df['time'] = dict_of_df[list(dict_of_df.keys())[0]]['time'].values
+    df['time'] = time
+    df['%s_m'%col] = stats['m']
+    df['%s_l'%col] = stats['l']
+    df['%s_u'%col] = stats['u']
 
-    for i in range(len(df)): 
-        values = []
-        for key in dict_of_df.keys():
-            values.append(dict_of_df[key].loc[i, col])
+    if percentiles:
+        df['%s_median'%col] = stats['median']
+        for p in percentiles:
+            df['%s_p%g'%(col, p)] = stats['p%g'%p]
 
-            m, l, u = mean_sd(values)
-            df.loc[i, ('%s_m'%col)] = m
-            df.loc[i, ('%s_l'%col)] = l
-            df.loc[i, ('%s_u'%col)] = u
-    
     return df
 
-def process_data(file_location, data_files, col, limb, cycle):
-    dict_ = get_normalized_data(file_location, data_files, col, limb, cycle)
-    df = get_ensembled_data(dict_, col)
+def process_groups(file_location, groups, percentiles=None):
+    results = []
+
+    for (data_files, col, limb, cycle), dict_ in zip(groups, get_normalized_groups(file_location, groups)):
+        df = get_ensembled_data(dict_, col, percentiles)
+
+        for key in dict_.keys():
+            dict_[key] = dict_[key].rename(columns={col: 'col'})
 
-    for key in dict_.keys():
-        dict_[key] = dict_[key].rename(columns={col: 'col'})
+        results.append((dict_, df))
     
-    return dict_, df
+    return results
+
+def process_data(file_location, data_files, col, limb, cycle, percentiles=None):
+    return process_groups(file_location, [(data_files, col, limb, cycle)], percentiles)[0]
+
+def short_columns(df):
+    # time, m, l, u (and median, p25, ...) as sent to the charts
+    return ['time'] + [col.split('_')[-1] for col in df.columns if col != 'time']
+
+def stream_response(records):
+    # newline-delimited JSON, flushed record by record; a failure ends the stream with an error record
+    def generate():
+        try:
+            for record in records:
+                yield record
+        except Exception as e:
+            app.logger.exception('Streaming /process_form_data failed')
+            yield ndjson_line({'type': 'error', 'message': str(e)})
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def stream_groups(file_location, groups, fmt, percentiles=None):
+    # {'type': 'trial', 'group', 'key', 'data'} per trial as soon as it is normalized,
+    # then {'type': 'ensemble', 'group', 'data', 'mnmx'} per group and {'type': 'done'}
+    tasks, plans = plan_groups(file_location, groups)
+
+    curves = [{} for _ in groups]
+    for g, key, curve in iter_normalized_groups(groups, tasks, plans):
+        curves[g][key] = curve
+        with metrics.stage('serialize'):
+            line = ndjson_line({'type': 'trial', 'group': g + 1, 'key': key,
+                                'data': encode_frame(curve.rename(columns={groups[g][1]: 'col'}), fmt)})
+        yield line
+
+    for g, plan in enumerate(plans):
+        df = get_ensembled_data({key: curves[g][key] for key in group_keys(plan)}, groups[g][1], percentiles)
+        df.columns = short_columns(df)
+        with metrics.stage('serialize'):
+            line = ndjson_line({'type': 'ensemble', 'group': g + 1, 'data': encode_frame(df, fmt), 'mnmx': mnmx(df['m'].values)})
+        yield line
+
+    yield ndjson_line({'type': 'done', 'format': fmt})
+
+def stream_stp(file_location, group1_size, fmt):
+    # {'type': 'stp', 'group', 'index', 'data'} per subject as it finishes; index holds the
+    # positions of the rows in the group's selection
+    for positions, df in iter_stp_params(file_location):
+        for g, rows in ((1, [r for r, p in enumerate(positions) if p < group1_size]),
+                        (2, [r for r, p in enumerate(positions) if p >= group1_size])):
+            if rows:
+                offset = 0 if g == 1 else group1_size
+                yield ndjson_line({'type': 'stp', 'group': g, 'index': [positions[r] - offset for r in rows],
+                                   'data': encode_frame(df.iloc[rows].reset_index(drop=True), fmt)})
+
+    yield ndjson_line({'type': 'done', 'format': fmt})
 
 def get_col(col, limb):
     if limb == 'Agg':
@@ -278,6 +381,117 @@ def get_col(col, limb):
     
     return col_
 
+def selection_paths(fileLocation, files):
+    # <group>/<sid>_<trial> -> <fileLocation><group>/<sid>/<sid>_<trial>
+    return [fileLocation + file.split('/')[0] + '/' + file.split('/')[1].split('_')[0] + '/' + file.split('/')[1] for file in files]
+
+def selection_groups(fileLocation, form_data):
+    # (data_files, col, limb, cycle) of group 1 and, when selected, group 2 of a curve request
+    col = form_data.get('selectedColumn')
+    if(col == 'AP' or col == 'ML' or col == 'VT'): type = 'grf'
+    else: type = 'jnt'
+
+    groups = []
+    for n in (1, 2):
+        files = form_data.get('group%dSelectedFiles' % n)
+        if n == 2 and not files:
+            break
+        footing = form_data.get('selectedFooting%d' % n)
+        data_files = [file + '_%s.csv'%type for file in selection_paths(fileLocation, files)]
+        groups.append((data_files, get_col(col, footing), footing, form_data.get('selectedCycle%d' % n)))
+
+    return groups
+
+def trial_key(file_location, file, col, limb, cycle):
+    # curve cache key of the trial (file signatures included), plus the limb that picks/sums its sides
+    _, task = trial_task(file_location, file, col, cycle)
+    return curve_key(task[0], task[1], col, cycle) + (limb,)
+
+def group_features(file_location, group):
+    # features of every trial of a group, from the feature cache or computed in one
+    # vectorized pass over the trials that are not cached, and of the group's mean curve
+    data_files, col, limb, cycle = group
+    keys = [trial_task(file_location, file, col, cycle)[0] for file in data_files]
+    fkeys = [('features',) + trial_key(file_location, file, col, limb, cycle) for file in data_files]
+
+    with metrics.stage('feature_cache'):
+        features = {key: feature_cache.get(fkey) for key, fkey in zip(keys, fkeys)}
+        ensemble_key = ('ensemble', col, limb, cycle) + tuple(fkeys)
+        ensemble = feature_cache.get(ensemble_key)
+
+    # the mean curve needs every trial, otherwise only the uncached ones are normalized
+    todo = [i for i, key in enumerate(keys) if ensemble is None or features[key] is None]
+    if todo:
+        curves = get_normalized_data(file_location, [data_files[i] for i in todo], col, limb, cycle)
+        with metrics.stage('features'):
+            stacked, time, matrix = stack_curves(curves, col)
+            rows = {key: r for r, key in enumerate(stacked)}
+            missing = list({keys[i]: i for i in todo if features[keys[i]] is None}.values())
+            if missing:
+                for i, f in zip(missing, curve_features(matrix[[rows[keys[i]] for i in missing]], time)):
+                    features[keys[i]] = f
+                    feature_cache.put(fkeys[i], f)
+
+            if ensemble is None:
+                ensemble = curve_features(ensemble_stats(matrix)['m'], time)[0]
+                feature_cache.put(ensemble_key, ensemble)
+        metrics.count('computed_features', len(missing))
+
+    return {'trials': features, 'ensemble': ensemble, 'summary': summarize(list(features.values()))}
+
+def group_outliers(file_location, group, method='knn', k=5):
+    # (keys, scores, robust z-scores, k used by knn) of the trials of a group; trials without
+    # values score None. Only trials new to the column's pool are normalized and measured against it
+    data_files, col, limb, cycle = group
+    trials = {}
+    for file in data_files:
+        key, _ = trial_task(file_location, file, col, cycle)
+        trials.setdefault(trial_key(file_location, file, col, limb, cycle), (key, file))
+    pkeys = list(trials)
+
+    score_key = (col, limb, cycle, method, k) + tuple(pkeys)
+    with metrics.stage('outlier_cache'):
+        result = outlier_cache.get_scores(score_key)
+    if result is not None:
+        return result
+
+    # curves (missing points interpolated) of the trials normalized here, None without values
+    computed = {}
+    while True:
+        with outlier_cache.lock:
+            pool = outlier_cache.pool((col, limb, cycle), pkeys)
+            todo = [p for p in pool.missing(pkeys) if p not in computed]
+            if not todo:
+                new = [p for p in pool.missing(pkeys) if computed[p] is not None]
+                if new:
+                    outlier_cache.added += pool.add(new, np.vstack([computed[p] for p in new]))
+                valid = [p for p in pkeys if p in pool]
+                curves, distances = pool.select(valid)
+                break
+
+        # outside the lock; another request may have reset the pool meanwhile, then this repeats
+        normalized = get_normalized_data(file_location, [trials[p][1] for p in todo], col, limb, cycle)
+        with metrics.stage('outliers'):
+            stacked, _, matrix = stack_curves(normalized, col)
+            rows = {key: r for r, key in enumerate(stacked)}
+            matrix = fill_missing(matrix)
+            for p in todo:
+                row = matrix[rows[trials[p][0]]]
+                computed[p] = None if np.isnan(row).all() else row
+
+    with metrics.stage('outliers'):
+        scores = score_trials(curves, distances, method, k)
+        z = robust_z(scores)
+
+    valid = {p: i for i, p in enumerate(valid)}
+    result = ([trials[p][0] for p in pkeys],
+              [float(scores[valid[p]]) if p in valid else None for p in pkeys],
+              [float(z[valid[p]]) if p in valid else None for p in pkeys],
+              knn_k(len(valid), k) if method == 'knn' else None)
+    outlier_cache.put_scores(score_key, result)
+
+    return result
+
 # Test cmd line: curl -X POST -H "Content-Type: application/json" -d @payload.json http://127.0.0.1:5000/process_form_data
 # stroke_patients/011918ds_20,stroke_patients/012518cm_23,stroke_patients/081017bf_20
 # healthy_controls/081517ap_8,healthy_controls/090717jg_42,healthy_controls/101217al_29
@@ -295,75 +509,199 @@ def process_form_data():
         cycle1 = form_data.get('selectedCycle1') # L/R/NA
         footing2 = form_data.get('selectedFooting2') # L/R/Agg/NA
         cycle2 = form_data.get('selectedCycle2') # L/R/NA
+        percentiles = form_data.get('percentiles') # optional, e.g. [25, 75] adds median and percentile bands
+        if percentiles is not None and (not isinstance(percentiles, list) or
+                                        not all(isinstance(p, (int, float)) and not isinstance(p, bool) and 0 <= p <= 100 for p in percentiles)):
+            abort(400, 'percentiles must be a list of numbers between 0 and 100')
+
+        try:
+            fmt = negotiate(request, form_data.get('format')) # optional: records (default)/columns/msgpack
+        except ValueError as e:
+            abort(400, str(e))
+
+        # optional: stream trials as NDJSON records as soon as they are ready (also Accept: application/x-ndjson)
+        stream = wants_stream(request, form_data.get('stream'))
+        if stream and fmt == 'msgpack':
+            abort(400, 'msgpack responses cannot be streamed, use records or columns')
 
-        group1Files_loc = [fileLocation + file.split('/')[0] + '/' + file.split('/')[1].split('_')[0] + '/' + file.split('/')[1] for file in group1Files]
-        group2Files_loc = [fileLocation + file.split('/')[0] + '/' + file.split('/')[1].split('_')[0] + '/' + file.split('/')[1] for file in group2Files]
+        group1Files_loc = selection_paths(fileLocation, group1Files)
+        group2Files_loc = selection_paths(fileLocation, group2Files)
 
         # print(group2Files, group1Files)
         df_1, df_2, df_1_mnmx, df_2_mnmx = None, None, None, None
         dict_list_df1, dict_list_df2 = None, None
 
         if(col=='STP'):
-            df_1 = get_stp_params(group1Files_loc)
-            if group2Files: df_2 = get_stp_params(group2Files_loc)
+            # both groups in one batch so their trials share the worker pool
+            if stream:
+                return stream_response(stream_stp(group1Files_loc + (group2Files_loc if group2Files else []), len(group1Files_loc), fmt))
+
+            df_stp = get_stp_params(group1Files_loc + (group2Files_loc if group2Files else []))
+            df_1 = df_stp.iloc[:len(group1Files_loc)].reset_index(drop=True)
+            if group2Files: df_2 = df_stp.iloc[len(group1Files_loc):].reset_index(drop=True)
 
         else:
-            col_1 = get_col(col, footing1)
-            col_2 = get_col(col, footing2)
-            
-            if(col == 'AP' or col == 'ML' or col == 'VT'): type = 'grf'
-            else: type = 'jnt'
-            group1FilesLoc = [file + '_%s.csv'%type for file in group1Files_loc]
-            group2FilesLoc = [file + '_%s.csv'%type for file in group2Files_loc]
-
-            dict_df_1, df_1 = process_data(fileLocation, group1FilesLoc, col_1, footing1, cycle1)
-            df_1.columns = ['time'] + [col[-1] for col in df_1.columns if col != 'time']
-            dict_list_df1 = {key: df.to_dict(orient='records') for key, df in dict_df_1.items()}
+            groups = selection_groups(fileLocation, form_data)
+            if stream:
+                return stream_response(stream_groups(fileLocation, groups, fmt, percentiles))
 
-            if(group2Files):
-                dict_df_2, df_2 = process_data(fileLocation, group2FilesLoc, col_2, footing2, cycle2)
-                df_2.columns = ['time'] + [col[-1] for col in df_2.columns if col != 'time']
-                dict_list_df2 = {key: df.to_dict(orient='records') for key, df in dict_df_2.items()}
+            processed = process_groups(fileLocation, groups, percentiles)
 
+            dict_df_1, df_1 = processed[0]
+            df_1.columns = short_columns(df_1)
+            with metrics.stage('serialize'):
+                dict_list_df1 = encode_frames(dict_df_1, fmt)
 
-            # Add Local, global minima and maxima to the charts
-            # l_minima_1 = argrelextrema(df_1['m'].values, np.less)[0].tolist()
-            # l_maxima_1 = argrelextrema(df_1['m'].values, np.greater)[0].tolist()
-            # l_minima_2 = argrelextrema(df_2['m'].values, np.less)[0].tolist()
-            # l_maxima_2 = argrelextrema(df_2['m'].values, np.greater)[0].tolist()
+            if(group2Files):
+                dict_df_2, df_2 = processed[1]
+                df_2.columns = short_columns(df_2)
+                with metrics.stage('serialize'):
+                    dict_list_df2 = encode_frames(dict_df_2, fmt)
 
-            # g_minima_1 = df_1['m'].idxmin()
-            # g_maxima_1 = df_1['m'].idxmax()
-            # g_minima_2 = df_2['m'].idxmin()
-            # g_maxima_2 = df_2['m'].idxmax()
 
-            # df_1_mnmx = {'l_minima': l_minima_1, 'l_maxima': l_maxima_1, 'g_minima': g_minima_1, 'g_maxima': g_maxima_1}
-            # df_2_mnmx = {'l_minima': l_minima_2, 'l_maxima': l_maxima_2, 'g_minima': g_minima_2, 'g_maxima': g_maxima_2}
+            # Local, global minima and maxima of the mean curves for the charts
+            df_1_mnmx = mnmx(df_1['m'].values)
+            if(group2Files): df_2_mnmx = mnmx(df_2['m'].values)
 
             # Option to save normalized CSV files in frontend
 
         # df_1 = df_1.replace({np.nan: None})
         # print(df_1)
 
-        response = {
-            'df1': df_1.to_dict(orient='records'),
-            'df1_data': dict_list_df1,
-            'df1_mnmx': df_1_mnmx
-        }
-
-        if group2Files:
-            response.update({
-                'df2': df_2.to_dict(orient='records'),
-                'df2_data': dict_list_df2,
-                'df2_mnmx': df_2_mnmx
-            })
-
-        return jsonify(response)
+        with metrics.stage('serialize'):
+            response = {
+                'format': fmt,
+                'df1': encode_frame(df_1, fmt),
+                'df1_data': dict_list_df1,
+                'df1_mnmx': df_1_mnmx
+            }
+
+            if group2Files:
+                response.update({
+                    'df2': encode_frame(df_2, fmt),
+                    'df2_data': dict_list_df2,
+                    'df2_mnmx': df_2_mnmx
+                })
+
+            body, headers = make_body(response, fmt, request.headers.get('Accept-Encoding', ''))
+        return Response(body, headers=headers)
         
         #return jsonify({'df1': 'df_1', 'df2': 'df_2', 'df1_mnmx': 'df_1_mnmx', 'df2_mnmx': 'df_2_mnmx'})
     # else: 
     #     return render_template('index.html')
 
+@app.route('/features', methods=['POST'])
+def features():
+    # Extrema (indices into the 100-point curve), their values and timing (% cycle) and range
+    # of motion of every selected trial and of each group's mean curve. Same payload as
+    # /process_form_data; per-trial results are cached until the trial's files change
+    form_data = request.json
+    fileLocation = form_data.get('fileLocation')
+    if(fileLocation[-1] != '/'): fileLocation += '/'
+    if form_data.get('selectedColumn') == 'STP':
+        abort(400, 'features are computed for curves, not STP')
+
+    response = {}
+    for g, group in enumerate(selection_groups(fileLocation, form_data)):
+        response['group%d' % (g + 1)] = group_features(fileLocation, group)
+
+    return jsonify(response)
+
+@app.route('/compare', methods=['POST'])
+def compare():
+    # Where along the cycle the two groups differ: pointwise t and Cohen's d (group1 - group2)
+    # and clusters of |t| above the critical t with permutation p-values. significant lists
+    # the [start, end] cycle ranges (%) to shade. Same payload as /process_form_data plus
+    # optional alpha (0.05), permutations (1000) and seed (0)
+    form_data = request.json
+    fileLocation = form_data.get('fileLocation')
+    if(fileLocation[-1] != '/'): fileLocation += '/'
+    if form_data.get('selectedColumn') == 'STP':
+        abort(400, 'comparisons are computed for curves, not STP')
+
+    groups = selection_groups(fileLocation, form_data)
+    if len(groups) < 2:
+        abort(400, 'select trials for both groups')
+
+    try:
+        alpha = float(form_data.get('alpha', 0.05))
+        permutations = int(form_data.get('permutations', 1000))
+        seed = int(form_data.get('seed', 0))
+    except (TypeError, ValueError):
+        abort(400, 'alpha must be a number and permutations and seed integers')
+    if not 0 < alpha < 1 or permutations < 1 or seed < 0:
+        abort(400, 'alpha must be between 0 and 1, permutations positive and seed not negative')
+    if permutations > max_permutations:
+        abort(400, 'permutations must be at most %d, got %d' % (max_permutations, permutations))
+
+    matrices = []
+    for (data_files, col, limb, cycle), dict_ in zip(groups, get_normalized_groups(fileLocation, groups)):
+        _, time, matrix = stack_curves(dict_, col)
+        matrices.append(matrix)
+
+    with metrics.stage('compare'):
+        try:
+            result = compare_curves(matrices[0], matrices[1], time, alpha, permutations, seed)
+        except ValueError as e:
+            abort(400, str(e))
+
+    result['time'] = time.tolist()
+    return jsonify(result)
+
+@app.route('/outliers', methods=['POST'])
+def outliers():
+    # Outlier scores of every selected trial against the other trials of its group: method
+    # knn (mean distance to the k nearest trials, default), depth (1 - functional depth) or
+    # mahalanobis; higher is more unusual. z holds robust z-scores and outliers the keys
+    # with z above cutoff (default 3.5), most unusual first; k is the one used per group (at
+    # most its trials - 1). Same payload as /process_form_data
+    form_data = request.json
+    fileLocation = form_data.get('fileLocation')
+    if(fileLocation[-1] != '/'): fileLocation += '/'
+    if form_data.get('selectedColumn') == 'STP':
+        abort(400, 'outliers are scored on curves, not STP')
+
+    method = form_data.get('method', 'knn')
+    try:
+        k = int(form_data.get('k', 5))
+        cutoff = float(form_data.get('cutoff', 3.5))
+    except (TypeError, ValueError):
+        abort(400, 'k must be an integer and cutoff a number')
+    if method not in OUTLIER_METHODS:
+        abort(400, 'method must be one of %s' % ', '.join(OUTLIER_METHODS))
+    if k < 1:
+        abort(400, 'k must be positive')
+
+    response = {}
+    for g, group in enumerate(selection_groups(fileLocation, form_data)):
+        try:
+            keys, scores, z, group_k = group_outliers(fileLocation, group, method, k)
+        except ValueError as e:
+            abort(400, str(e))
+
+        flagged = sorted((z_, key) for key, z_ in zip(keys, z) if z_ is not None and z_ > cutoff)
+        response['group%d' % (g + 1)] = {'scores': dict(zip(keys, scores)), 'z': dict(zip(keys, z)),
+                                          'outliers': [key for _, key in reversed(flagged)], 'k': group_k}
+
+    response.update({'method': method, 'cutoff': cutoff})
+    return jsonify(response)
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(curve_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # latency histograms (s) per endpoint and stage, counters and cache stats; local clients only
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+
+    snapshot = metrics.registry.snapshot()
+    snapshot['curve_cache'] = curve_cache.stats()
+    snapshot['feature_cache'] = feature_cache.stats()
+    snapshot['outlier_cache'] = outlier_cache.stats()
+    return jsonify(snapshot)
+
 # df: time, l, m, u
 # df: sid, trial, RstepLength, LstepLength, timeRswing, timeLswing, timeRgait, timeLgait, GaitSpeed
 
@@ -0,0 +1,166 @@
+import math
+from itertools import combinations
+
+import numpy as np
+
+from executor import run_cpu_tasks
+
+# Pointwise two-group comparison of normalized curves, in the style of SPM{t}:
+# two-sample t-statistics (pooled variance) and Cohen's d at every cycle point,
+# computed for all points at once, and cluster-level inference by permuting the
+# group labels. Clusters are runs of points where |t| exceeds the two-tailed
+# critical t; a cluster's mass is the sum of its |t| and its p-value is the share
+# of permutations whose largest cluster mass (either sign) is at least as large.
+
+# permutations per pool task; fixed, so results do not depend on the pool size
+CHUNK = 250
+
+def critical_t(alpha, df):
+    from scipy.stats import t
+
+    return float(t.ppf(1 - alpha / 2, df))
+
+def _t(m1, m2, ss, n1, n2):
+    # pooled-variance t and Cohen's d; NaN where a group has fewer than 2 values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sd = np.sqrt(np.maximum(ss, 0) / (n1 + n2 - 2))
+        t = (m1 - m2) / (sd * np.sqrt(1 / n1 + 1 / n2))
+        d = (m1 - m2) / sd
+    few = (n1 < 2) | (n2 < 2)
+    return np.where(few, np.nan, t), np.where(few, np.nan, d)
+
+def pointwise(a, b):
+    '''
+    t-statistic and Cohen's d at every point of two (trials x points) matrices;
+    missing values only leave their own points out.
+    '''
+    n1, n2 = (~np.isnan(a)).sum(axis=0), (~np.isnan(b)).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1, m2 = np.nansum(a, axis=0) / n1, np.nansum(b, axis=0) / n2
+    ss = np.nansum((a - m1) ** 2, axis=0) + np.nansum((b - m2) ** 2, axis=0)
+
+    return _t(m1, m2, ss, n1, n2)
+
+def permuted_t(data, present, labels):
+    # t curves of every relabelling at once; data has missing values set to 0 and present
+    # marks the others, labels: (permutations x trials) booleans of group 1
+    L = labels.astype(float)
+    n1 = L @ present
+    n2 = present.sum(axis=0) - n1
+    sum1, sumsq1 = L @ data, L @ (data ** 2)
+    sum2, sumsq2 = data.sum(axis=0) - sum1, (data ** 2).sum(axis=0) - sumsq1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1, m2 = sum1 / n1, sum2 / n2
+        ss = (sumsq1 - n1 * np.nan_to_num(m1) ** 2) + (sumsq2 - n2 * np.nan_to_num(m2) ** 2)
+
+    return _t(m1, m2, ss, n1, n2)[0]
+
+def runs(mask):
+    '''
+    (row, start, end) of the runs of True along the rows of a 2-D mask; end is inclusive.
+    '''
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends - 1
+
+def cluster_masses(t, threshold):
+    # clusters of every row of t above threshold and below -threshold: (rows, starts, ends, masses, signs)
+    t = np.atleast_2d(np.nan_to_num(t))
+    found = []
+    for sign in (1, -1):
+        rows, starts, ends = runs(sign * t > threshold)
+        csum = np.concatenate([np.zeros((len(t), 1)), np.cumsum(np.abs(t), axis=1)], axis=1)
+        masses = csum[rows, ends + 1] - csum[rows, starts]
+        found.append((rows, starts, ends, masses, np.full(len(rows), sign)))
+
+    return tuple(np.concatenate(parts) for parts in zip(*found))
+
+def max_masses(t, threshold):
+    # largest cluster mass of every row (0 without clusters)
+    rows, _, _, masses, _ = cluster_masses(t, threshold)
+    largest = np.zeros(len(np.atleast_2d(t)))
+    np.maximum.at(largest, rows, masses)
+    return largest
+
+def permutation_chunk(data, present, n1, permutations, seed, threshold):
+    # null distribution of the largest cluster mass over random relabellings
+    rng = np.random.default_rng(seed)
+    keys = rng.random((permutations, len(data)))
+    labels = np.argsort(keys, axis=1) < n1
+    return max_masses(permuted_t(data, present, labels), threshold)
+
+def exact_null(data, present, n1, threshold, limit):
+    # every relabelling, when there are at most limit (the requested permutations) of them
+    n = len(data)
+    count = math.comb(n, n1)
+    if count > limit:
+        raise ValueError('%d relabellings are more than the %d permutations asked for' % (count, limit))
+    labels = np.zeros((count, n), dtype=bool)
+    for i, group1 in enumerate(combinations(range(n), n1)):
+        labels[i, list(group1)] = True
+    return max_masses(permuted_t(data, present, labels), threshold)
+
+def compare_curves(a, b, time, alpha=0.05, permutations=1000, seed=0):
+    '''
+    Compare two (trials x points) matrices sampled at time (% cycle). Trials without values
+    are left out. Returns the pointwise t and d curves and the supra-threshold
+    clusters with their permutation p-values; significant lists the (start, end) cycle
+    ranges of the clusters with p < alpha.
+    '''
+    a = a[~np.isnan(a).all(axis=1)]
+    b = b[~np.isnan(b).all(axis=1)]
+    n1, n2 = len(a), len(b)
+    if n1 < 2 or n2 < 2:
+        raise ValueError('each group needs at least 2 trials, got %d and %d' % (n1, n2))
+
+    # clusters are formed at the critical t of complete data; the permutations use the
+    # same threshold, so missing points do not bias the cluster p-values
+    if permutations < 1:
+        raise ValueError('permutations must be positive, got %d' % permutations)
+    # decided before anything is allocated: exact_null holds one row per relabelling
+    exact = math.comb(n1 + n2, n1) <= permutations
+
+    df = n1 + n2 - 2
+    threshold = critical_t(alpha, df)
+    t, d = pointwise(a, b)
+
+    data = np.vstack([a, b])
+    present = (~np.isnan(data)).astype(float)
+    # t is unchanged by the shift, which keeps the sums of squares of the relabellings accurate
+    with np.errstate(invalid='ignore'):
+        data = np.nan_to_num(data - np.nanmean(data, axis=0))
+
+    if exact:
+        # the observed labelling is one of them
+        null = exact_null(data, present, n1, threshold, permutations)
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(math.ceil(permutations / CHUNK))
+        sizes = [min(CHUNK, permutations - i * CHUNK) for i in range(len(seeds))]
+        null = np.concatenate(run_cpu_tasks(permutation_chunk, [(data, present, n1, size, s, threshold) for size, s in zip(sizes, seeds)]))
+
+    clusters = []
+    _, starts, ends, masses, signs = cluster_masses(t, threshold)
+    for start, end, mass, sign in sorted(zip(starts.tolist(), ends.tolist(), masses.tolist(), signs.tolist())):
+        # masses of the observed labelling may differ from its permuted copy by rounding
+        at_least = null >= mass * (1 - 1e-9)
+        p = np.mean(at_least) if exact else (np.sum(at_least) + 1) / (len(null) + 1)
+        clusters.append({'start': start, 'end': end, 'start_time': float(time[start]), 'end_time': float(time[end]),
+                         'sign': sign, 'mass': mass, 'p': float(p)})
+
+    return {
+        't': [None if np.isnan(v) else float(v) for v in t],
+        'd': [None if np.isnan(v) else float(v) for v in d],
+        'df': df,
+        'alpha': alpha,
+        'threshold': threshold,
+        'permutations': len(null),
+        'exact': exact,
+        'n1': n1,
+        'n2': n2,
+        'clusters': clusters,
+        'significant': [[c['start_time'], c['end_time']] for c in clusters if c['p'] < alpha],
+    }
@@ -0,0 +1,58 @@
+import os
+import time
+
+from server import app, dir_index
+import metadata
+from cycle_store import DATA_TYPES, build_group, map_store
+
+# Production entry point, run from backend/:
+#
+#     gunicorn -c gunicorn.conf.py wsgi:app
+#
+# gunicorn.conf.py preloads this module in the master process, so the warm-up below runs
+# once before the workers fork and everything it loads is shared by them (the listing
+# and step/demographic indexes copy-on-write, the cycle matrices as shared mapped pages):
+#   VIGMA_DATA_ROOT    data root(s) to preload, separated by os.pathsep; use the same path
+#                      the frontend sends as fileLocation
+#   VIGMA_WARM_GROUPS  comma-separated groups whose cycle store is brought up to date and
+#                      mapped (default: every group of the root)
+#   VIGMA_WARM_BUILD   0 to map the existing cycle store without rebuilding stale groups
+
+def list_groups(root):
+    with os.scandir(root) as it:
+        return sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir())
+
+def warm_up(root, groups=None, build=True):
+    start = time.perf_counter()
+
+    _, _, subjects = dir_index.listing(root)
+    tables = metadata.preload(root)
+
+    groups = groups or list_groups(root)
+    if build:
+        for group in groups:
+            for data_type in DATA_TYPES:
+                build_group(os.path.abspath(root), group, data_type)
+    mapped = map_store(root, groups)
+
+    print('Warmed up %s: %d subject(s), %d step/demographic table(s), %.1f MB of cycle matrices in %.1f s'
+          % (root, subjects, tables, mapped / 1024 / 1024, time.perf_counter() - start))
+
+warm_groups = [g.strip() for g in os.environ.get('VIGMA_WARM_GROUPS', '').split(',') if g.strip()]
+warm_build = os.environ.get('VIGMA_WARM_BUILD', '1') != '0'
+
+for root in os.environ.get('VIGMA_DATA_ROOT', '').split(os.pathsep):
+    if root:
+        warm_up(root, warm_groups, warm_build)
+
+if __name__ == '__main__':
+    # Without gunicorn (e.g. on Windows): waitress when it is installed, else Flask's threaded server
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+
+    if serve is not None:
+        serve(app, host='0.0.0.0', port=5000, threads=int(os.environ.get('VIGMA_SERVER_THREADS', 8)))
+    else:
+        app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,217 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+'''
+Synthetic data trees for the benchmarks, laid out like a real VIGMA data root:
+
+    <root>/<group>/demographic.csv
+    <root>/<group>/<sid>/<sid>step.csv
+    <root>/<group>/<sid>/<sid>_<trial>.trc (or .c3d)
+    <root>/<group>/<sid>/<sid>_<trial>_jnt.csv
+    <root>/<group>/<sid>/<sid>_<trial>_grf.csv
+
+Usage: python generate.py <root> [--subjects 10] [--trials 3] [--markers trc|c3d|none] [--seed 0]
+
+Markers follow a planar two-segment leg model walking along x (mm), so joint angles,
+touch downs/toe offs and ground reaction forces of a trial are consistent with each
+other. A small fraction of marker samples is dropped (blank in TRC, 0 in C3D) and of
+joint-angle samples left missing, so the imputers have work to do. The same seed
+always gives the same tree.
+'''
+
+GROUPS = ('patients', 'controls')
+MARKERS = ['heel', 'toe', 'knee', 'ankle', 'hip', 'shoulder']
+JNT_COLUMNS = ['#frame', 'Rfoot', 'Lfoot', 'Rshank', 'Lshank', 'Rthigh', 'Lthigh', 'trunk', 'hipx', 'time']
+GRF_COLUMNS = ['time', 'L-AP', 'R-AP', 'L-ML', 'R-ML', 'L-VT', 'R-VT']
+STEP_COLUMNS = ['subject', 'trial', 'trialtype'] + ['touch down', 'toe off', 'footing'] * 4
+
+FRAME_RATE = 120
+MARKER_DROP = 0.005
+JNT_MISSING = 0.01
+
+def subject_ids(subjects):
+    # <6 digits><2 letters>, like the ids of the study data (e.g. 081517ap)
+    return [('%06d%s' % (i, 'bp' if i % 2 == 0 else 'bc'), GROUPS[i % 2]) for i in range(subjects)]
+
+def gait_events(rng, first):
+    '''
+    Touch downs / toe offs (s) of two strides starting with foot first ('L' or 'R').
+    '''
+    stride = rng.uniform(0.95, 1.25)
+    start = rng.uniform(0.4, 0.8)
+    stance = rng.uniform(0.58, 0.64) * stride
+
+    events = []
+    for k in range(4):
+        td = start + k * stride / 2
+        events.append((td, td + stance, first if k % 2 == 0 else ('R' if first == 'L' else 'L')))
+
+    return stride, events
+
+def walk(rng, stride, events, thigh, shank):
+    '''
+    Marker trajectories (frames x markers x 3, mm) of one walking trial.
+    '''
+    duration = events[-1][1] + rng.uniform(0.5, 1.0)
+    t = np.arange(int(duration * FRAME_RATE)) / FRAME_RATE
+    speed = rng.uniform(900, 1400)
+
+    touch_down = {foot: td for td, _, foot in events[:2]}
+    pos = {}
+    for side, y in (('Left', 120.0), ('Right', -120.0)):
+        phase = 2 * np.pi * (t - touch_down[side[0]]) / stride
+        hip = np.stack([speed * t, np.full_like(t, y), 920 + 12 * np.sin(2 * phase)], axis=1)
+
+        # segment angles from vertical (rad); the thigh is furthest forward at touch down
+        a_thigh = np.radians(22 * np.cos(phase) + 5)
+        a_shank = a_thigh - np.radians(30 * (1 - np.cos(phase - 0.9)) / 2 + 3)
+        knee = hip + thigh * 1000 * np.stack([np.sin(a_thigh), 0 * t, -np.cos(a_thigh)], axis=1)
+        ankle = knee + shank * 1000 * np.stack([np.sin(a_shank), 0 * t, -np.cos(a_shank)], axis=1)
+
+        pos[side + ' hip'] = hip
+        pos[side + ' knee'] = knee
+        pos[side + ' ankle'] = ankle
+        pos[side + ' heel'] = ankle + [-55, 0, -65]
+        pos[side + ' toe'] = ankle + [150, 0, -70]
+        pos[side + ' shoulder'] = hip + [25, 0, 480]
+
+    names = [side + ' ' + m for side in ('Right', 'Left') for m in MARKERS]
+    markers = np.stack([pos[n] for n in names], axis=1)
+    markers += rng.normal(0, 0.5, markers.shape)
+
+    return t, names, markers
+
+def joint_angles(rng, t, names, markers):
+    # segment angles as motionToJointAngle computes them, with some samples missing
+    def angle(up, low):
+        v = markers[:, names.index(up)] - markers[:, names.index(low)]
+        return np.degrees(np.arctan2(v[:, 2], v[:, 0]))
+
+    cols = {'#frame': np.arange(1, len(t) + 1)}
+    for seg, (up, low) in (('foot', ('heel', 'toe')), ('shank', ('knee', 'ankle')), ('thigh', ('hip', 'knee'))):
+        for side in ('Right', 'Left'):
+            cols[side[0] + seg] = angle(side + ' ' + up, side + ' ' + low)
+    for foot in ('Rfoot', 'Lfoot'):
+        cols[foot] = np.where(cols[foot] > 150, cols[foot] - 180, cols[foot])
+        cols[foot] = np.where(cols[foot] < -150, cols[foot] + 360, cols[foot])
+    cols['trunk'] = (angle('Right shoulder', 'Right hip') + angle('Left shoulder', 'Left hip')) / 2
+    cols['hipx'] = (markers[:, names.index('Right hip'), 0] + markers[:, names.index('Left hip'), 0]) / 2000
+    cols['time'] = t
+
+    df = pd.DataFrame(cols, columns=JNT_COLUMNS)
+    values = df[JNT_COLUMNS[1:-1]].to_numpy(copy=True)
+    values[rng.random(values.shape) < JNT_MISSING] = np.nan
+    df[JNT_COLUMNS[1:-1]] = values
+
+    return df
+
+def ground_reaction(rng, t, events, mass):
+    # double-hump vertical force and biphasic AP force (N) during each stance
+    weight = mass * 9.81
+    cols = {c: np.zeros_like(t) for c in GRF_COLUMNS[1:]}
+
+    for td, to, foot in events:
+        stance = (t >= td) & (t <= to)
+        s = (t[stance] - td) / (to - td)
+        cols[foot + '-VT'][stance] += weight * (np.sin(np.pi * s) + 0.25 * np.sin(3 * np.pi * s))
+        cols[foot + '-AP'][stance] += -0.2 * weight * np.sin(2 * np.pi * s)
+        cols[foot + '-ML'][stance] += 0.05 * weight * np.sin(np.pi * s)
+
+    df = pd.DataFrame(cols)
+    df += rng.normal(0, 2.0, df.shape)
+    df.insert(0, 'time', t)
+
+    return df[GRF_COLUMNS]
+
+def write_trc(path, rng, t, names, markers):
+    n, m = len(t), len(names)
+    values = markers.reshape(n, -1).copy()
+    values[np.repeat(rng.random((n, m)) < MARKER_DROP, 3, axis=1)] = np.nan
+
+    with open(path, 'w') as f:
+        f.write('PathFileType\t4\t(X/Y/Z)\t%s\n' % os.path.basename(path))
+        f.write('DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n')
+        f.write('%d\t%d\t%d\t%d\tmm\t%d\t1\t%d\n' % (FRAME_RATE, FRAME_RATE, n, m, FRAME_RATE, n))
+        f.write('Frame#\tTime\t' + '\t\t\t'.join(names) + '\t\t\t\n')
+        f.write('\t\t' + '\t'.join('X%d\tY%d\tZ%d' % (i, i, i) for i in range(1, m + 1)) + '\t\n')
+        f.write('\n')
+
+    body = pd.DataFrame(values)
+    body.insert(0, 'time', t)
+    body.insert(0, 'frame', np.arange(1, n + 1))
+    body.to_csv(path, mode='a', sep='\t', header=False, index=False, float_format='%.5f', na_rep='')
+
+def write_c3d(path, rng, t, names, markers):
+    import c3d
+
+    n, m = len(t), len(names)
+    points = np.zeros((n, m, 5), dtype=np.float32)
+    points[:, :, :3] = markers
+    # dropped samples read back as 0
+    points[rng.random((n, m)) < MARKER_DROP] = 0
+
+    writer = c3d.Writer(point_rate=float(FRAME_RATE))
+    writer.set_point_labels(names)
+    writer.add_frames([(points[i], np.zeros((0, 0), dtype=np.float32)) for i in range(n)])
+    with open(path, 'wb') as handle:
+        writer.write(handle)
+
+def generate_tree(root, subjects=10, trials=3, markers='trc', seed=0):
+    '''
+    Write a synthetic data tree of subjects (split over GROUPS) with trials each. Returns root.
+    '''
+    if markers not in ('trc', 'c3d', 'none'):
+        raise ValueError("markers must be 'trc', 'c3d' or 'none', got %r" % markers)
+
+    demographics = {group: [] for group in GROUPS}
+    for sid, group in subject_ids(subjects):
+        rng = np.random.default_rng([seed, int(sid[:6])])
+        subject_dir = os.path.join(root, group, sid)
+        os.makedirs(subject_dir, exist_ok=True)
+
+        thigh, shank = rng.uniform(0.38, 0.48), rng.uniform(0.36, 0.46)
+        mass = rng.uniform(55, 95)
+        demographics[group].append({'id': sid, 'thigh': thigh, 'shank': shank})
+
+        steps = []
+        for trial in range(1, trials + 1):
+            stride, events = gait_events(rng, 'L' if rng.random() < 0.5 else 'R')
+            t, names, pos = walk(rng, stride, events, thigh, shank)
+            base = os.path.join(subject_dir, '%s_%d' % (sid, trial))
+
+            if markers == 'trc':
+                write_trc(base + '.trc', rng, t, names, pos)
+            elif markers == 'c3d':
+                write_c3d(base + '.c3d', rng, t, names, pos)
+
+            joint_angles(rng, t, names, pos).to_csv(base + '_jnt.csv', index=False)
+            ground_reaction(rng, t, events, mass).to_csv(base + '_grf.csv', index=False)
+
+            row = [sid, trial, 'walk']
+            for td, to, foot in events:
+                row += [round(td, 4), round(to, 4), foot]
+            steps.append(row)
+
+        pd.DataFrame(steps, columns=STEP_COLUMNS).to_csv(os.path.join(subject_dir, '%sstep.csv' % sid), index=False)
+
+    for group, rows in demographics.items():
+        if rows:
+            pd.DataFrame(rows, columns=['id', 'thigh', 'shank']).to_csv(os.path.join(root, group, 'demographic.csv'), index=False)
+
+    return root
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic VIGMA data tree.')
+    parser.add_argument('root')
+    parser.add_argument('--subjects', type=int, default=10)
+    parser.add_argument('--trials', type=int, default=3)
+    parser.add_argument('--markers', default='trc', choices=['trc', 'c3d', 'none'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_tree(args.root, args.subjects, args.trials, args.markers, args.seed)
+    print('Generated %d subject(s) x %d trial(s) under %s' % (args.subjects, args.trials, args.root), file=sys.stderr)
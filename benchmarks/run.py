@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '..', 'notebooks'))
+sys.path.append(os.path.join(HERE, '..', 'backend'))
+
+from generate import GROUPS, generate_tree
+
+'''
+Timings of the library functions and the backend endpoints on a synthetic data tree.
+
+Usage: python run.py [--subjects 10] [--trials 3] [--repeat 5] [--only case,...]
+                     [--save NAME] [--compare NAME] [--threshold 1.25]
+
+The tree (benchmarks/data/<subjects>x<trials>) is generated on first use. Library
+cases time one call on each of --sample trials in turn; endpoint cases go through the
+Flask test client with --selection trials per group. Endpoint cases named 'cold' clear
+the server's in-memory indexes and caches and the on-disk caches of the tree
+(.vigma/, imputed .vgb copies, <sid>sptmp.csv) before every repetition; 'warm' cases
+run against whatever the previous repetition left behind.
+
+--save writes the results to benchmarks/baselines/NAME.json. --compare prints the ratio
+of every median to the one in a saved baseline and exits with status 1 when a case is
+more than --threshold times slower.
+'''
+
+BASELINE_DIR = os.path.join(HERE, 'baselines')
+
+def measure(fn, repeat, setup=None):
+    '''
+    Seconds taken by fn() in each of repeat runs; setup() runs untimed before each one.
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+def summarize(times):
+    return {'median': statistics.median(times), 'min': min(times), 'mean': statistics.fmean(times), 'runs': len(times)}
+
+def data_root(subjects, trials):
+    root = os.path.join(HERE, 'data', '%dx%d' % (subjects, trials))
+    if not os.path.exists(os.path.join(root, GROUPS[0], 'demographic.csv')):
+        print('Generating %d subject(s) x %d trial(s) under %s' % (subjects, trials, root))
+        generate_tree(root, subjects, trials)
+
+    return root
+
+def list_trials(root):
+    # (group, sid, trial) of every trial in the tree, in a fixed order
+    trials = []
+    for group in GROUPS:
+        group_dir = os.path.join(root, group)
+        for sid in sorted(os.listdir(group_dir)):
+            if not os.path.isdir(os.path.join(group_dir, sid)):
+                continue
+            for file in sorted(os.listdir(os.path.join(group_dir, sid))):
+                if file.endswith('_jnt.csv'):
+                    trials.append((group, sid, int(file.split('_')[1])))
+
+    return trials
+
+def clear_disk_caches(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        if '.vigma' in dirnames:
+            shutil.rmtree(os.path.join(dirpath, '.vigma'))
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+
+        for file in filenames:
+            if (file.startswith('.') and file.endswith('.vgb')) or file.endswith('sptmp.csv'):
+                os.remove(os.path.join(dirpath, file))
+
+def library_cases(root, sample):
+    from format_convert import read_trc
+    from feature_extraction import motionToJointAngle, get_sptmp_params
+    from preprocessing import filter_data, knn_impute, mice_impute, normalize_data
+
+    trials = list_trials(root)[:sample]
+    base = ['%s/%s/%s/%s_%d' % (root, group, sid, sid, trial) for group, sid, trial in trials]
+
+    motion = [read_trc(b + '.trc')[0] for b in base]
+    jnt = [pd.read_csv(b + '_jnt.csv') for b in base]
+    imputed = [knn_impute(df) for df in jnt]
+    steps = [pd.read_csv('%s/%s/%s/%sstep.csv' % (root, group, sid, sid)) for group, sid, _ in trials]
+    subjects = sorted(set((group, sid) for group, sid, _ in trials))
+
+    def each(fn, items):
+        # one call per item, cycling through the sample
+        items = iter(items * 2)
+        return lambda: fn(next(items))
+
+    return {
+        'motionToJointAngle': each(lambda df: motionToJointAngle(df, interactive=False), motion),
+        'filter_data': each(lambda df: filter_data(df, data_type='jnt'), imputed),
+        'knn_impute': each(lambda df: knn_impute(df, data_type='jnt'), jnt),
+        'mice_impute': each(lambda df: mice_impute(df, data_type='jnt'), jnt),
+        'normalize_data': each(lambda args: normalize_data(args[0], args[1], args[2][1], args[2][2]), list(zip(imputed, steps, trials))),
+        'get_sptmp_params': each(lambda s: get_sptmp_params(os.path.join(root, s[0]), s[1], persist=False), subjects),
+    }
+
+def endpoint_cases(root, selection):
+    import server
+    import metadata
+
+    client = server.app.test_client()
+    trials = list_trials(root)
+    selected = {group: ['%s/%s_%d' % (g, sid, trial) for g, sid, trial in trials if g == group][:selection] for group in GROUPS}
+
+    def post(path, payload):
+        def call():
+            response = client.post(path, json=payload)
+            if response.status_code != 200:
+                raise RuntimeError('%s returned %d: %s' % (path, response.status_code, response.get_data(as_text=True)[:200]))
+            return response.get_data()
+        return call
+
+    def form(column, footing1, cycle1, footing2, cycle2):
+        return post('/process_form_data', {'fileLocation': root,
+                                           'group1SelectedFiles': selected[GROUPS[0]], 'group2SelectedFiles': selected[GROUPS[1]],
+                                           'selectedColumn': column,
+                                           'selectedFooting1': footing1, 'selectedCycle1': cycle1,
+                                           'selectedFooting2': footing2, 'selectedCycle2': cycle2})
+
+    def cold():
+        server.curve_cache.clear()
+        server.dir_index.clear()
+        metadata.clear()
+        clear_disk_caches(root)
+
+    send = post('/send-data', {'fileLocation': root})
+    jnt = form('thigh', 'L', 'L', 'L', 'L')
+    grf = form('VT', 'Agg', 'L', 'R', 'R')
+    stp = form('STP', 'NA', 'NA', 'NA', 'NA')
+
+    return {
+        'send-data cold': (send, cold),
+        'send-data warm': (send, None),
+        'process_form_data jnt cold': (jnt, cold),
+        'process_form_data jnt warm': (jnt, None),
+        'process_form_data grf cold': (grf, cold),
+        'process_form_data grf warm': (grf, None),
+        'process_form_data stp cold': (stp, cold),
+        'process_form_data stp warm': (stp, None),
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(subjects=10, trials=3, repeat=5, sample=10, selection=30, only=None):
+    root = data_root(subjects, trials)
+
+    cases = {name: (fn, None) for name, fn in library_cases(root, sample).items()}
+    cases.update(endpoint_cases(root, selection))
+    if only:
+        cases = {name: case for name, case in cases.items() if any(o in name for o in only)}
+
+    results = {}
+    for name, (fn, setup) in cases.items():
+        results[name] = summarize(measure(fn, repeat, setup))
+        print('%-30s %10.2f ms (min %.2f ms)' % (name, results[name]['median'] * 1000, results[name]['min'] * 1000))
+
+    meta = {'subjects': subjects, 'trials': trials, 'repeat': repeat, 'sample': sample, 'selection': selection,
+            'revision': git_revision(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+    return {'meta': meta, 'results': results}
+
+def compare(report, baseline, threshold=1.25):
+    '''
+    Print new/baseline median ratios. Returns the names of the cases slower than threshold.
+    '''
+    slower = []
+    print('\n%-30s %12s %12s %8s' % ('case', 'baseline', 'now', 'ratio'))
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['median']
+        ratio = result['median'] / old if old > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  slower'
+            slower.append(name)
+        elif ratio < 1 / threshold:
+            flag = '  faster'
+        print('%-30s %9.2f ms %9.2f ms %7.2fx%s' % (name, old * 1000, result['median'] * 1000, ratio, flag))
+
+    if baseline['meta'].get('subjects') != report['meta']['subjects'] or baseline['meta'].get('trials') != report['meta']['trials']:
+        print('\nNote: the baseline was recorded on a %sx%s tree' % (baseline['meta'].get('subjects'), baseline['meta'].get('trials')))
+
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the VIGMA library and backend on a synthetic data tree.')
+    parser.add_argument('--subjects', type=int, default=10)
+    parser.add_argument('--trials', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--sample', type=int, default=10, help='trials used by the library cases')
+    parser.add_argument('--selection', type=int, default=30, help='trials per group sent to /process_form_data')
+    parser.add_argument('--only', default=None, help='comma-separated substrings of the case names to run')
+    parser.add_argument('--save', default=None, help='record the results as baselines/NAME.json')
+    parser.add_argument('--compare', default=None, help='compare with baselines/NAME.json (or a path)')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    report = run(args.subjects, args.trials, args.repeat, args.sample, args.selection, args.only.split(',') if args.only else None)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, args.save + '.json')
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('\nSaved %s' % path)
+
+    if args.compare:
+        path = args.compare if os.path.exists(args.compare) else os.path.join(BASELINE_DIR, args.compare + '.json')
+        with open(path, 'r') as f:
+            slower = compare(report, json.load(f), args.threshold)
+        if slower:
+            print('\n%d case(s) slower than %.2fx the baseline: %s' % (len(slower), args.threshold, ', '.join(slower)))
+            sys.exit(1)
@@ -0,0 +1,302 @@
+import json
+import os
+import re
+import sys
+import threading
+import numpy as np
+
+from metadata import get_step
+from resample import resample_batch
+from trial_store import load_table, atomic_write
+
+'''
+Materialized gait-cycle matrices: the normalized (100-point) cycles of every trial of a
+group, one contiguous (trials x 100) float64 matrix per variable and cycle.
+
+    <root>/.vigma/cycles/<group>/<data_type>/index.json
+    <root>/.vigma/cycles/<group>/<data_type>/<column>_<cycle>.<version>.npy
+
+index.json lists the trial ids ('<sid>_<trial>') in row order and, per trial, the
+(mtime, size) signatures of its data and step files. Rebuilding only recomputes trials
+whose signatures changed, and each rebuild writes a new version of the matrices so
+readers holding the previous index keep consistent rows; that version is removed by
+the rebuild after. Cycles are cut like the server and
+resampled with resample.py (as normalize_data), so stored rows equal freshly computed curves.
+
+Usage: python cycle_store.py <data root> [--force]
+'''
+
+POINTS = 100
+CYCLES = ('L', 'R')
+DATA_TYPES = ('jnt', 'grf')
+STORE_DIR = os.path.join('.vigma', 'cycles')
+SKIP_COLUMNS = ('#frame', 'time')
+
+def file_signature(path):
+    # (mtime, size) of a file, None if it is missing; also keys the server's curve cache
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def trial_signature(data_path, step_path):
+    # signatures of a trial's data and step files, as lists like in index.json
+    return [None if s is None else list(s) for s in (file_signature(data_path), file_signature(step_path))]
+
+def store_path(root, group, data_type):
+    return os.path.join(root, STORE_DIR, group, data_type)
+
+def trim_cycle(data, data_step, cycle):
+    # gait cycle between alternate touch downs of the requested foot
+    if(data_step['footing'] == 'L'):
+        if(cycle == 'L'): return data[(data['time'] >= data_step['touch down']) & (data['time'] <= data_step['touch down.2'])]
+        else: return data[(data['time'] >= data_step['touch down.1']) & (data['time'] <= data_step['touch down.3'])]
+    else:
+        if(cycle == 'L'): return data[(data['time'] >= data_step['touch down.1']) & (data['time'] <= data_step['touch down.3'])]
+        else: return data[(data['time'] >= data_step['touch down']) & (data['time'] <= data_step['touch down.2'])]
+
+def find_trials(group_dir, data_type):
+    '''
+    Return [(trial id, data csv, step csv, sid, trial)] for every <sid>/<sid>_<trial>_<data_type>.csv of a group.
+    '''
+    trials = []
+    with os.scandir(group_dir) as it:
+        subjects = sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir())
+
+    for sid in subjects:
+        pattern = re.compile(r'^%s_(\d+)_%s\.csv$' % (re.escape(sid), data_type))
+        with os.scandir(os.path.join(group_dir, sid)) as it:
+            files = sorted((int(m.group(1)), e.name) for e in it for m in [pattern.match(e.name)] if m)
+
+        for trial, file in files:
+            trials.append(('%s_%d' % (sid, trial), os.path.join(group_dir, sid, file),
+                           os.path.join(group_dir, sid, '%sstep.csv' % sid), sid, trial))
+
+    return trials
+
+def read_index(path):
+    try:
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _matrix_file(path, column, cycle, version):
+    return os.path.join(path, '%s_%s.%d.npy' % (column, cycle, version))
+
+def build_group(root, group, data_type, force=False):
+    '''
+    Bring the matrices of one group and data type up to date. Returns (computed, reused, skipped).
+    '''
+    trials = find_trials(os.path.join(root, group), data_type)
+    path = store_path(root, group, data_type)
+    previous = read_index(path)
+
+    if not trials:
+        return 0, 0, 0
+
+    columns = [c for c in load_table(trials[0][1]).columns if c not in SKIP_COLUMNS]
+    old = previous if not force and previous is not None and previous['columns'] == columns else None
+
+    old_rows = {key: i for i, key in enumerate(old['trials'])} if old else {}
+    old_matrices = {}
+    if old:
+        for column in columns:
+            for cycle in CYCLES:
+                old_matrices[(column, cycle)] = np.load(_matrix_file(path, column, cycle, old['version']), mmap_mode='r')
+
+    keys, signatures, skipped, rows = [], {}, {}, {}
+    computed, reused = 0, 0
+
+    for key, data_path, step_path, sid, trial in trials:
+        signature = trial_signature(data_path, step_path)
+
+        if key in old_rows and old['signatures'][key] == signature:
+            i = old_rows[key]
+            rows[key] = {k: m[i] for k, m in old_matrices.items()}
+            reused += 1
+        elif old and old.get('skipped', {}).get(key, [None])[0] == signature:
+            skipped[key] = old['skipped'][key]
+            continue
+        else:
+            try:
+                data_step = get_step(step_path, sid, trial) if signature[1] is not None else None
+                if data_step is None:
+                    raise ValueError('trial not in step file')
+
+                data = load_table(data_path)
+                cycles = [trim_cycle(data, data_step, cycle)[columns].to_numpy(dtype=np.float64) for cycle in CYCLES]
+                curves = resample_batch(cycles, POINTS)
+                rows[key] = {(column, cycle): curves[c][:, j] for c, cycle in enumerate(CYCLES) for j, column in enumerate(columns)}
+                computed += 1
+            except (ValueError, KeyError) as e:
+                rows.pop(key, None)
+                skipped[key] = [signature, str(e)]
+                continue
+
+        keys.append(key)
+        signatures[key] = signature
+
+    if old and computed == 0 and keys == old['trials'] and skipped == old.get('skipped', {}):
+        return computed, reused, len(skipped)
+
+    version = previous['version'] + 1 if previous else 0
+    os.makedirs(path, exist_ok=True)
+    for column in columns:
+        for cycle in CYCLES:
+            matrix = np.empty((len(keys), POINTS))
+            for i, key in enumerate(keys):
+                matrix[i] = rows[key][(column, cycle)]
+
+            with atomic_write(_matrix_file(path, column, cycle, version)) as f:
+                np.save(f, matrix)
+
+    index = {'version': version, 'points': POINTS, 'columns': columns, 'cycles': list(CYCLES),
+             'trials': keys, 'signatures': signatures, 'skipped': skipped}
+    with atomic_write(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    # Readers that opened the previous index map its matrices lazily, so that version is
+    # kept until the next rebuild; only versions before it are removed
+    old_matrices.clear()
+    for file in os.listdir(path):
+        match = re.match(r'^.+_[LR]\.(\d+)\.npy$', file)
+        if match and int(match.group(1)) < version - 1:
+            try:
+                os.remove(os.path.join(path, file))
+            except OSError:
+                pass
+
+    return computed, reused, len(skipped)
+
+def build_cycle_store(root, force=False):
+    '''
+    Materialize the normalized cycles of every group under root into <root>/.vigma/cycles.
+    Only trials whose data or step file changed since the last build are recomputed.
+    '''
+    totals = [0, 0, 0]
+
+    with os.scandir(root) as it:
+        groups = sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir())
+
+    for group in groups:
+        for data_type in DATA_TYPES:
+            counts = build_group(root, group, data_type, force)
+            totals = [t + c for t, c in zip(totals, counts)]
+
+    print('Normalized %d trial(s), %d up to date, %d skipped (missing or invalid step times)' % tuple(totals), '\n')
+
+    return tuple(totals)
+
+''' reading '''
+
+_groups = {}
+_lock = threading.Lock()
+
+def open_group(root, group, data_type):
+    '''
+    Return the index of a stored group (with a 'rows' lookup), or None when nothing is stored.
+    Matrices are memory-mapped on first use; the index is re-read when it is rebuilt.
+    '''
+    path = store_path(root, group, data_type)
+    try:
+        mtime = os.stat(os.path.join(path, 'index.json')).st_mtime_ns
+    except OSError:
+        return None
+
+    entry = _groups.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+
+    with _lock:
+        entry = _groups.get(path)
+        if entry is None or entry[0] != mtime:
+            index = read_index(path)
+            if index is None:
+                return None
+            index['path'] = path
+            index['rows'] = {key: i for i, key in enumerate(index['trials'])}
+            index['matrices'] = {}
+            entry = (mtime, index)
+            _groups[path] = entry
+
+    return entry[1]
+
+def get_matrix(index, column, cycle):
+    matrix = index['matrices'].get((column, cycle))
+    if matrix is None:
+        matrix = np.load(_matrix_file(index['path'], column, cycle, index['version']), mmap_mode='r')
+        index['matrices'][(column, cycle)] = matrix
+    return matrix
+
+def get_curves(requests):
+    '''
+    Look up stored cycles for [(data csv, step csv, column, cycle)] requests.
+    Returns one 100-point array per request, or None where the store has no
+    up-to-date row (not built, new trial, or a data/step file changed since).
+    '''
+    results = [None] * len(requests)
+    batches = {}
+
+    for i, (data_path, step_path, column, cycle) in enumerate(requests):
+        sid_dir = os.path.dirname(os.path.abspath(data_path))
+        group_dir = os.path.dirname(sid_dir)
+        match = re.match(r'^(.+)_(\d+)_(%s)\.csv$' % '|'.join(DATA_TYPES), os.path.basename(data_path))
+        if match is None:
+            continue
+
+        key = '%s_%d' % (match.group(1), int(match.group(2)))
+        batch = (os.path.dirname(group_dir), os.path.basename(group_dir), match.group(3), column, cycle)
+        batches.setdefault(batch, []).append((i, key, trial_signature(data_path, step_path)))
+
+    for (root, group, data_type, column, cycle), items in batches.items():
+        index = open_group(root, group, data_type)
+        if index is None or column not in index['columns'] or cycle not in index['cycles']:
+            continue
+
+        hits = [(i, index['rows'][key]) for i, key, signature in items
+                if key in index['rows'] and index['signatures'][key] == signature]
+        if not hits:
+            continue
+
+        # one fancy-indexed read of the rows of this selection. A matrix removed by
+        # rebuilds since this index was read counts as a miss
+        try:
+            block = np.asarray(get_matrix(index, column, cycle)[[row for _, row in hits]])
+        except OSError:
+            continue
+        for (i, _), curve in zip(hits, block):
+            results[i] = curve
+
+    return results
+
+def map_store(root, groups=None):
+    '''
+    Memory-map the stored matrices of groups (default: every stored group) and read them
+    once, so lookups find them in memory. Mapped before a server forks its workers, the
+    pages are shared by all workers instead of each holding a copy. Returns the bytes mapped.
+    '''
+    root = os.path.abspath(root)
+    if groups is None:
+        store = os.path.join(root, STORE_DIR)
+        groups = sorted(os.listdir(store)) if os.path.isdir(store) else []
+
+    mapped = 0
+    for group in groups:
+        for data_type in DATA_TYPES:
+            index = open_group(root, group, data_type)
+            if index is None:
+                continue
+            for column in index['columns']:
+                for cycle in index['cycles']:
+                    matrix = get_matrix(index, column, cycle)
+                    # touch every page
+                    matrix.sum()
+                    mapped += matrix.nbytes
+
+    return mapped
+
+if __name__ == '__main__':
+    # python cycle_store.py <data root> [--force]
+    build_cycle_store(sys.argv[1], force='--force' in sys.argv[2:])
@@ -1,7 +1,10 @@
 from format_convert import *
 from feature_extraction import *
-from preprocessing import filter_data, interpolate_impute, knn_impute, mice_impute, normalize_data
+from preprocessing import filter_data, interpolate_impute, knn_impute, mice_impute, block_mice_impute, normalize_data
 from utils import plot, save, read, load_VA
+from trial_store import convert_tree
+from cycle_store import build_cycle_store
+from imputation import local_knn_impute, gap_impute, impute_tree
 
 __all__ = [
     trcToCSV,
@@ -14,10 +17,16 @@ __all__ = [
     interpolate_impute,
     knn_impute,
     mice_impute,
+    block_mice_impute,
+    local_knn_impute,
+    gap_impute,
+    impute_tree,
     mark_step_times,
     normalize_data,
     plot,
     save,
     read,
-    load_VA
+    load_VA,
+    convert_tree,
+    build_cycle_store
 ]
\ No newline at end of file
@@ -5,8 +5,8 @@ import pandas as pd
 import os
 import time
 from fuzzywuzzy import fuzz
-from preprocessing import knn_impute
-from utils import remove_empty_columns
+from spatiotemporal import STP_COLUMNS, compute_stp, get_stp
+from resample import interp_columns
 
 def closest_match(word, words_list):
     '''
@@ -36,11 +36,12 @@ def closest_match(word, words_list):
     return max_v, max_x
 
 
-def match_col_names(columns):
+def match_col_names(columns, interactive=True):
     '''
     Match column names to the expected format. 
     If there are any missing, or if the names are not close enough to the expected format, return False. 
     Else, return a dictionary of the column names to be renamed.
+    With interactive=False the mapping is accepted without a prompt unless a column is missing.
     '''
 
     # Left or lt, right or rt -> heel, toe, knee, ankle, hip or g trochanter, shoulder or mth
@@ -63,6 +64,12 @@ def match_col_names(columns):
         if fuzz_ratio < 80:
             missing_cols.append(c)
 
+    if not interactive:
+        if missing_cols:
+            print('Possible missing columns in file: ', missing_cols)
+            return
+        return rename_cols
+
     print('{:<25} {}'.format("Columns in CSV", 'Mapped Column'))
     print('{:<25} {}'.format("______________", '_____________'))
     for key, value in rename_cols.items():
@@ -87,19 +94,19 @@ def cal_seg_angles(up_marker, low_marker):
     Calculate segment angles.
     '''
 
-    xs = up_marker.iloc[:, 0] - low_marker.iloc[:, 0]
-    ys = up_marker.iloc[:, 2] - low_marker.iloc[:, 2]
+    xs = np.asarray(up_marker.iloc[:, 0] - low_marker.iloc[:, 0], dtype=float)
+    ys = np.asarray(up_marker.iloc[:, 2] - low_marker.iloc[:, 2], dtype=float)
 
-    angles = []
-    for x, y in zip(xs, ys):
-        if x == 0:
-            angle = math.pi / 2
-        else:
-            angle = math.atan2(y, x)
+    return seg_angles(xs, ys)
 
-        angles.append(math.degrees(angle))
 
-    return angles
+def seg_angles(xs, ys):
+    '''
+    Angle (deg) of the segment vector (xs, ys) in the sagittal plane; vertical when xs is 0.
+    Works elementwise on arrays of any shape.
+    '''
+
+    return np.where(xs == 0, math.degrees(math.pi / 2), np.degrees(np.arctan2(ys, xs)))
 
 
 def extract_JNT_df(df):
@@ -112,86 +119,72 @@ def extract_JNT_df(df):
     shank (left, right) -> knee(up_marker), ankle (low_marker)
     thigh (left, right) -> hip(up_marker), knee (low_marker)
     trunk (left, right) -> (shoulder(up_marker) + hip(low_marker)) / 2
-    '''
-
-    def process_row(row, foot):
-        time_value = row['time']
-        foot_value = row[foot]
-        
-        if foot_value < -150:
-            row[foot] = foot_value + 360
-       
-        return row
 
-    df_jnt = pd.DataFrame()
-
-    df_jnt['time'] = df['time'].reset_index(drop=True)
-    df_jnt['#frame'] = df['frame#'].reset_index(drop=True)
+    All segments of both sides are computed at once on a (frames x markers x 3) array,
+    then every column is resampled to 120 Hz in one pass.
+    '''
 
     seg = ['foot', 'shank', 'thigh', 'trunk']
     mot = [('heel', 'toe'), ('knee', 'ankle'),
            ('hip', 'knee'), ('shoulder', 'hip')]
 
-    
-    for i in range(len(seg)):
-        up_marker_rt = df['Right '+mot[i][0]].astype(float)
-        up_marker_lt = df['Left '+mot[i][0]].astype(float)
-        low_marker_rt = df['Right '+mot[i][1]].astype(float)
-        low_marker_lt = df['Left '+mot[i][1]].astype(float)
+    markers = ['heel', 'toe', 'knee', 'ankle', 'hip', 'shoulder']
+    names = [side + ' ' + m for side in ('Right', 'Left') for m in markers]
+    pos = np.stack([df[name].iloc[:, :3].to_numpy(dtype=float) for name in names], axis=1)
 
-        angles_rt = cal_seg_angles(up_marker_rt, low_marker_rt)
-        angles_rt = pd.Series(angles_rt, dtype=float)
+    # (segment, side) pairs in output order: Rfoot, Lfoot, Rshank, Lshank, ...
+    up = [names.index(side + ' ' + up_m) for up_m, _ in mot for side in ('Right', 'Left')]
+    low = [names.index(side + ' ' + low_m) for _, low_m in mot for side in ('Right', 'Left')]
+    vec = pos[:, up, :] - pos[:, low, :]
+    angles = seg_angles(vec[:, :, 0], vec[:, :, 2])
 
-        angles_lt = cal_seg_angles(up_marker_lt, low_marker_lt)
-        angles_lt = pd.Series(angles_lt, dtype=float)
+    time = df['time'].to_numpy(dtype=float)
+    frame = df['frame#'].to_numpy(dtype=float)
 
+    columns = ['#frame']
+    block = [frame]
+    for i in range(len(seg)):
         if (seg[i] == 'trunk'):
-            df_jnt['trunk'] = (angles_rt + angles_lt) / 2
-
+            columns.append('trunk')
+            block.append((angles[:, 2*i] + angles[:, 2*i+1]) / 2)
         else:
-            df_jnt['R'+seg[i]] = angles_rt
-            df_jnt['L'+seg[i]] = angles_lt
-
-    # print(df['Left hip'].iloc[:, 0].astype(float))
-    df_jnt['hipx'] = (df['Left hip'].iloc[:, 0].astype(float) + df['Right hip'].iloc[:, 0].astype(float)) / (2 * 1000)
+            columns.extend(['R'+seg[i], 'L'+seg[i]])
+            block.extend([angles[:, 2*i], angles[:, 2*i+1]])
 
-    if (df_jnt['Rfoot'] > 150).any():
-        df_jnt['Rfoot'] = df_jnt['Rfoot'] - 180
-    if(df_jnt['Lfoot'] > 150).any():
-        df_jnt['Lfoot'] = df_jnt['Lfoot'] - 180
+    columns.append('hipx')
+    block.append((pos[:, names.index('Left hip'), 0] + pos[:, names.index('Right hip'), 0]) / (2 * 1000))
+    block = np.column_stack(block)
 
-    # For 'Rfoot', 'Lfoot', if the value is < -150 add 360 to it
+    # foot angles: shift by 180 if any value is > 150, then wrap values < -150 by 360
     for foot in ['Rfoot', 'Lfoot']:
-        df_jnt[foot] = df_jnt[foot].astype(float)
-        df_jnt = df_jnt.apply(process_row, axis=1, args=(foot,))
+        j = columns.index(foot)
+        if (block[:, j] > 150).any():
+            block[:, j] = block[:, j] - 180
+        block[:, j] = np.where(block[:, j] < -150, block[:, j] + 360, block[:, j])
 
     start_time = 0
-    end_time = df_jnt['time'].iloc[-1]
+    end_time = time[-1]
     new_time = np.arange(start_time, end_time, 1/120)
-    new_time = np.append(new_time, df_jnt['time'].iloc[-1])
+    new_time = np.append(new_time, time[-1])
     # remove first element from new_time
     new_time = new_time[1:]
 
-    new_df_jnt = pd.DataFrame(index=new_time)
-
     # Interpolate the values for the new time intervals
-    for column in df_jnt.columns:
-        if column != 'time':
-            new_df_jnt[column] = np.interp(new_time, df_jnt['time'], df_jnt[column])
-
+    new_df_jnt = pd.DataFrame(interp_columns(new_time, time, block), columns=columns)
     new_df_jnt['time'] = new_time
-    new_df_jnt = new_df_jnt.reset_index(drop=True)
 
     return new_df_jnt
 
-def motionToJointAngle(df, save = False, replace = False):
+def motionToJointAngle(df, save = False, replace = False, rename_cols = None, interactive = True):
 
-    columns = list(set(df.columns))
-    columns = [c[0] for c in columns]
-    columns = [c for c in columns if c not in ('frame#', 'time')]
-    columns = list(set(columns))
+    if rename_cols is None:
+        columns = list(set(df.columns))
+        columns = [c[0] for c in columns]
+        columns = [c for c in columns if c not in ('frame#', 'time')]
+        columns = list(set(columns))
+
+        rename_cols = match_col_names(columns, interactive)
 
-    rename_cols = match_col_names(columns)
     if rename_cols is None:
         return
     else:
@@ -202,68 +195,10 @@ def motionToJointAngle(df, save = False, replace = False):
     return df
     
 def extract_sptmp(filepath, pid, trial):
-    jnts = pd.read_csv(filepath + '/' + pid + '/' + pid + "_" + str(trial) + "_jnt.csv")
-    jnts  = remove_empty_columns(jnts)
-    jnts = knn_impute(jnts, data_type='jnt')
-    
-    # grfs = pd.read_csv(filepath + '/' + pid + '/' + pid + "_" + str(trial) + "_grf.csv")
-    dem = pd.read_csv(filepath + '/' + "demographic.csv")
+    params = compute_stp(filepath, pid, [trial]).iloc[0]
+    return tuple(params[STP_COLUMNS[2:]])
 
-    sts = pd.read_csv(filepath + "/" + pid + '/' + pid + "step.csv")
-
-    jnts.columns = jnts.columns.str.strip()
-    # grfs.columns = grfs.columns.str.strip()
-    dem.columns = dem.columns.str.strip()
-
-    thigh = dem[dem['id'] == pid]['thigh'].values[0]
-    shank = dem[dem['id'] == pid]['shank'].values[0]
-
-    first_step = sts[sts['trial'] == trial].footing.values[0]
-    trials = list(sts['trial'])
-
-    trial_index = trials.index(trial)
-
-    TDs = sts.filter(like='touch').values[trial_index]
-    LOs = sts.filter(like='off').values[trial_index]
-
-    timeswing1 = LOs[1] - TDs[1]
-    timeswing2 = LOs[0] - TDs[0]
-    timegait1 = TDs[3] - TDs[1]
-    timegait2 = TDs[2] - TDs[0]
-
-    timeRswing = timeswing1 if first_step == 'L' else timeswing2
-    timeLswing = timeswing2 if first_step == 'L' else timeswing1
-    timeRgait = timegait1 if first_step == 'L' else timegait2
-    timeLgait = timegait2 if first_step == 'L' else timegait1
-
-    Rshank = jnts.Rshank.values/180*np.pi
-    Lshank = jnts.Lshank.values/180*np.pi
-    Rthigh = jnts.Rthigh.values/180*np.pi
-    Lthigh = jnts.Lthigh.values/180*np.pi
-    hipx = jnts.hipx.values
-
-    # Nan values in hipx
-    # if(type(hipx[0]) == str):
-    #     hipx = np.array([float(value.strip()) if value.strip().lower() != 'nan' else np.nan for value in hipx])
-    
-
-    TD1 = int(round(TDs[0]*120))
-    TD2 = int(round(TDs[1]*120))
-    TD3 = int(round(TDs[2]*120))
-
-    if(first_step == 'R'):
-        RstepLength = -np.cos(Rthigh[TD1])*thigh - np.cos(Rshank[TD1])*shank + np.cos(Lthigh[TD1])*thigh + np.cos(Lshank[TD1])*shank
-        LstepLength =  np.cos(Rthigh[TD2])*thigh + np.cos(Rshank[TD2])*shank - np.cos(Lthigh[TD2])*thigh - np.cos(Lshank[TD2])*shank
-
-    else:
-        RstepLength = -np.cos(Rthigh[TD2])*thigh - np.cos(Rshank[TD2])*shank + np.cos(Lthigh[TD2])*thigh + np.cos(Lshank[TD2])*shank
-        LstepLength =  np.cos(Rthigh[TD1])*thigh + np.cos(Rshank[TD1])*shank - np.cos(Lthigh[TD1])*thigh - np.cos(Lshank[TD1])*shank
-
-    GaitSpeed = np.mean((np.diff(hipx)*120)[TD1-1:TD3])
-
-    return RstepLength, LstepLength, timeRswing, timeLswing, timeRgait, timeLgait, GaitSpeed
-
-def get_sptmp_params(file_location, pid):
+def get_sptmp_params(file_location, pid, persist = True):
     files = os.listdir(file_location + "/" + pid)
 
     pattern = r'_(\d+)_'
@@ -277,17 +212,10 @@ def get_sptmp_params(file_location, pid):
     # Convert the set to a sorted list to display the trial numbers in order
     trials = sorted(list(trials))
 
-    stpParams = []
-
-    for trial in trials:
-        RstepLength, LstepLength, timeRswing, timeLswing, timeRgait, timeLgait, GaitSpeed = extract_sptmp(file_location, pid, trial)
-        stpParams.append([pid, trial, RstepLength, LstepLength, timeRswing, timeLswing, timeRgait, timeLgait, GaitSpeed])
-
-    df = pd.DataFrame(stpParams, columns=['sid', 'trial', 'RstepLength', 'LstepLength', 'timeRswing', 'timeLswing', 'timeRgait', 'timeLgait', 'GaitSpeed'])
-
-    return df
+    # all trials in one batch, looked up in <pid>sptmp.csv when it is up to date
+    return get_stp(file_location, pid, trials, persist=persist)
 
-def mark_step_times(file_dir, patient_id, trial, L, R, trialtype):
+def mark_step_times(file_dir, patient_id, trial, L, R, trialtype, overwrite = None):
 
     if(L[0][0] < L[1][0]):
         p1, p2, p3, p4 = L[0], R[0], L[1], R[1]
@@ -300,12 +228,13 @@ def mark_step_times(file_dir, patient_id, trial, L, R, trialtype):
         df_step = pd.read_csv('%s/%s/%sstep.csv' % (file_dir, patient_id, patient_id))
         
         if not df_step[(df_step['trial'] == trial) & (df_step['trialtype'] == trialtype)].empty:
-            print('Step time for trial already exists. Do you want to overwrite: ? (y/n)')
-            time.sleep(0.5)
-            answer = input()
-            if answer == 'y':
+            if overwrite is None:
+                print('Step time for trial already exists. Do you want to overwrite: ? (y/n)')
+                time.sleep(0.5)
+                overwrite = input() == 'y'
+            if overwrite:
                 new_row = {'subject': patient_id, 'trial': trial, 'trialtype': trialtype, 'touch down': p1[0], 'toe off': p1[1], 'footing': f1, 'touch down.1': p2[0], 'toe off.1': p2[1], 'footing.1': f2, 'touch down.2': p3[0], 'toe off.2': p3[1], 'footing.2': f3, 'touch down.3': p4[0], 'toe off.3': p4[1], 'footing.3': f4}
-                df_step = df_step[(df_step['trial'] != trial) & (df_step['trialtype'] != trialtype)]
+                df_step = df_step[~((df_step['trial'] == trial) & (df_step['trialtype'] == trialtype))]
                 df_step = pd.concat([df_step, pd.DataFrame(new_row, index=[0])], ignore_index=True)
 
                 df_step = df_step.sort_values(by=['subject', 'trial'])
@@ -11,52 +11,87 @@ warnings.filterwarnings(
     "ignore", message="No analog data found in file.")
 
 
-def trcToCSV(file_dir, patient_id, trial_no, replace = False):
-    """
-    To get metadata from trc file:
-    mocap_data = TRCData()
-    mocap_data.load(fildir)
+TRC_KEYWORDS = ['frame#', 'time', 'head', 'ear', 'shoulder', 'elbow', 'wrist', 'hand', 'hip', 'knee', 'ankle', 'foot',
+                'toe', 'sacrum', 'scapula', 'tibia', 'g.trochanter', 'heel', 'mth', 'thigh', 'fixed', 'fix']
 
-    #  'DataRate', 'CameraRate', 'NumFrames', 'NumMarkers', 'Units', 'OrigDataRate', 
-    #  'OrigDataStartFrame', 'OrigNumFrames', 'OrigNumMarkers'
-    #  Ex: mocap_data['NumFrames']
-    """
-    
-    file = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '.trc'
-    # find the line number where the data starts
+
+def _trc_value(value):
+    try:
+        return float(value) if '.' in value else int(value)
+    except ValueError:
+        return value
+
+
+def read_trc(file):
+    '''
+    Read a TRC file into a (marker, axis) MultiIndex dataframe in one pass.
+    Returns (df, meta) where meta holds the header fields, e.g. meta['DataRate'],
+    meta['NumFrames'], meta['NumMarkers'], meta['Units'].
+    '''
+    # find the line where the column names start
     with open(file, 'r') as f:
-        for line_count, line in enumerate(f, start=1):
-            if any(word.lower() in line for word in ['frame#', 'time', 'head', 'ear', 'shoulder', 'elbow', 'wrist', 'hand', 'hip', 'knee', 'ankle', 'foot',
-                                                     'toe', 'sacrum', 'scapula', 'tibia', 'g.trochanter', 'heel', 'mth', 'thigh', 'fixed', 'fix']):
+        lines = []
+        for line in f:
+            lines.append(line.rstrip('\r\n'))
+            if line.startswith('Frame#') or any(word.lower() in line for word in TRC_KEYWORDS):
                 break
-
-    # skip the lines before the data starts and read the data
-    df = pd.read_csv(file, delimiter="\t",
-                     skiprows=[i for i in range(line_count-1)], header=[0, 1])
+        axis_line = f.readline().rstrip('\r\n')
+        # the field count of the data rows, from the first row with values
+        for line in f:
+            if line.strip():
+                fields = len(line.rstrip('\r\n').split('\t'))
+                break
+        else:
+            fields = 0
+    header_row = len(lines) - 1
+
+    # the fixed header: a row of field names followed by a row of values
+    meta = {}
+    for i in range(header_row - 1):
+        if lines[i].startswith('DataRate'):
+            meta = dict(zip(lines[i].split('\t'), [_trc_value(v) for v in lines[i + 1].split('\t')]))
+
+    names = lines[header_row].split('\t')
+    axes = axis_line.split('\t')
+
+    col_tuples = [('frame#', ''), ('time', '')]
+    for j in range(2, len(axes)):
+        # trailing tabs leave empty columns; only labelled axes are kept
+        if not axes[j]:
+            break
+        if j < len(names) and names[j]:
+            z = names[j].split(':')[0]
+        col_tuples.append((z, axes[j][0]))
+
+    # frame# is read as float too: the blank (or tab-only) line exporters leave after the
+    # axis row comes back as a row of NaN and an integer column cannot hold it. The names
+    # fix the column count, which would otherwise be taken from that short line
+    df = pd.read_csv(file, sep='\t', header=None, names=range(max(fields, len(col_tuples))), skiprows=header_row + 2,
+                     usecols=range(len(col_tuples)), dtype=np.float64, engine='c')
 
     # drop a row if all values are NaN (in trc file, apparently they skip a line after column names)
     df = df.dropna(how='all')
+    df[0] = df[0].astype(np.int64) if df[0].notna().all() else df[0].astype('Int64')
+    df.columns = pd.MultiIndex.from_tuples(col_tuples)
 
-    col_tuples = []
-    for i in range(len(df.columns)):
-        c = df.columns[i]
-        if (c[0] == 'Frame#'):
-            tup = list(('frame#', ''))
-            c = tuple(tup)
-        elif (c[0] == 'Time'):
-            tup = list(('time', ''))
-            c = tuple(tup)
-        else:
-            if (c[0].split(':')[0] == 'Unnamed'):
-                c = (z, c[1][0])
-            else:
-                z = c[0].split(':')[0]
-                c = (z, c[1][0])
+    # the header's counts only serve as a check; cropped or re-exported files do not always update them
+    if isinstance(meta.get('NumFrames'), int) and meta['NumFrames'] != len(df):
+        warnings.warn('%s: header says %d frames, read %d' % (file, meta['NumFrames'], len(df)))
+    if isinstance(meta.get('NumMarkers'), int) and meta['NumMarkers'] != (len(col_tuples) - 2) // 3:
+        warnings.warn('%s: header says %d markers, read %d' % (file, meta['NumMarkers'], (len(col_tuples) - 2) // 3))
+
+    return df, meta
 
-        col_tuples.append(c)
 
-    df_cols = pd.MultiIndex.from_tuples(col_tuples)
-    df.columns = df_cols
+def trcToCSV(file_dir, patient_id, trial_no, replace = False):
+    """
+    Read the TRC file into a Pandas dataframe.
+    The header metadata ('DataRate', 'CameraRate', 'NumFrames', 'NumMarkers', 'Units', ...)
+    is available through read_trc(file)[1].
+    """
+
+    file = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '.trc'
+    df, meta = read_trc(file)
 
     save_filepath = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '.csv'
     if(replace or not os.path.exists(save_filepath)):
@@ -72,6 +107,26 @@ def trcToCSV(file_dir, patient_id, trial_no, replace = False):
     return df
 
 
+def find_qtm_struct(annots):
+    '''
+    Return the QTM export struct of a loadmat() dict: the first variable with a
+    Trajectories field (falls back to the first non-dunder variable).
+    '''
+    variables = [k for k in annots if not k.startswith('__')]
+    for k in variables:
+        names = getattr(annots[k], 'dtype', None)
+        if names is not None and names.names is not None and 'Trajectories' in names.names:
+            return annots[k]
+    return annots[variables[0]]
+
+
+def _field(struct, name, pos):
+    # QTM field by name, by position for structs without field names
+    if struct.dtype.names is not None and name in struct.dtype.names:
+        return struct[name].item()
+    return struct.item()[pos]
+
+
 def matToCSV(file_dir, patient_id, trial_no, replace = False):
     '''
     Read the MAT file into a Pandas dataframe.
@@ -79,42 +134,32 @@ def matToCSV(file_dir, patient_id, trial_no, replace = False):
 
     file = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '.mat'
     annots = loadmat(file, squeeze_me=True)
-    # struct = annots['qtm_022318xz0004']
-    struct = annots[list(annots.keys())[3]]
+    struct = find_qtm_struct(annots)
+
+    labeled = _field(_field(struct, 'Trajectories', 5), 'Labeled', 0)
+    col_names = np.atleast_1d(_field(labeled, 'Labels', 1))
 
-    col_names = struct.item()[5].item()[0].item()[1]
+    # (markers, 4, frames) -> (frames, markers*3), dropping the residual row
+    arr3d = np.asarray(_field(labeled, 'Data', 2), dtype=np.float64)
+    arr3d = arr3d.reshape(len(col_names), -1, arr3d.shape[-1])
+    data = arr3d[:, :3, :].transpose(2, 0, 1).reshape(arr3d.shape[-1], -1)
 
     col_tuples = []
     for c in col_names:
         col_tuples.extend([(c, 'X'), (c, 'Y'), (c, 'Z')])
 
-    arr3d = struct.item()[5].item()[0].item()[2]
-
-    df = pd.DataFrame()
-    cnt = 0
-
-    for arr2d in arr3d:
-        for i in range(3):
-            cnt += 1
-            col = arr2d[i]
-            df[str(cnt)] = pd.Series(col)
-
-    df_cols = pd.MultiIndex.from_tuples(col_tuples)
-    df.columns = df_cols
+    df = pd.DataFrame(data, columns=pd.MultiIndex.from_tuples(col_tuples))
 
-    frame_no = annots[list(annots.keys())[3]].item()[3]
-    frame_rate = annots[list(annots.keys())[3]].item()[4]
-
-    col_frames = [i for i in range(1, int(frame_no)+1)]
-    col_time = [i/frame_rate for i in range(0, int(frame_no))]
+    frame_no = int(_field(struct, 'Frames', 3))
+    frame_rate = _field(struct, 'FrameRate', 4)
 
     df.insert(loc=0,
               column='frame#',
-              value=col_frames)
+              value=np.arange(1, frame_no + 1))
 
     df.insert(loc=1,
               column='time',
-              value=col_time)
+              value=np.arange(frame_no) / frame_rate)
 
     save_filepath = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '.csv'
     if(replace or not os.path.exists(save_filepath)):
@@ -130,52 +175,91 @@ def matToCSV(file_dir, patient_id, trial_no, replace = False):
     return df
 
 
-def c3dToCSV(file_dir, patient_id, trial_no, replace = False):
+def write_csv_chunked(df, path, chunksize=10000, widen=None):
+    '''
+    Write df to CSV chunksize rows at a time. Columns in widen are cast to float64 per
+    chunk, so their text matches a float64 frame without holding a float64 copy of df.
+    '''
+    widen = {c: np.float64 for c in (widen or [])}
+
+    for start in range(0, max(len(df), 1), chunksize):
+        chunk = df.iloc[start:start + chunksize].astype(widen)
+        chunk.to_csv(path, index=False, mode='w' if start == 0 else 'a', header=(start == 0))
+
+
+def c3dToCSV(file_dir, patient_id, trial_no, replace = False, analog = False, chunksize = 10000):
+    '''
+    Read the C3D file into a Pandas dataframe (float32 marker coordinates).
+    Frames are streamed into a preallocated array and the CSV is written in chunks.
+    With analog=True the analog channels are also saved (<id>_<trial>_analog.csv)
+    and (df, df_analog) is returned.
+    '''
 
     file = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '.c3d'
     with open(file, "rb") as handle:
         reader = c3d.Reader(handle)
-        frames = []
 
-        for i, points, analog in reader.read_frames():
-            frames.append(points[:, :3].flatten().tolist())
+        col_names = [c.strip() for c in reader.point_labels]
+        frame_no = int(reader.frame_count)
+        frame_rate = reader.point_rate
+        analog_per_frame = int(reader.analog_per_frame)
+        # files without analog channels have no ANALOG:LABELS; df_analog is then empty
+        analog_used = int(reader.analog_used) if analog else 0
 
-        col_names = reader.point_labels
+        points_arr = np.empty((frame_no, 3 * len(col_names)), dtype=np.float32)
+        if analog:
+            analog_arr = np.empty((frame_no * analog_per_frame, analog_used), dtype=np.float32)
 
-        col_tuples = []
-        for c in col_names:
-            col_tuples.extend(
-                [(c.strip(), 'X'), (c.strip(), 'Y'), (c.strip(), 'Z')])
+        n = 0
+        for i, points, analog_frame in reader.read_frames(copy=False):
+            points_arr[n] = points[:, :3].reshape(-1)
+            if analog_used:
+                analog_arr[n * analog_per_frame:(n + 1) * analog_per_frame] = np.asarray(analog_frame).T
+            n += 1
 
-        frame_no = reader.frame_count
-        frame_rate = reader.point_rate
+        analog_labels = [c.strip() for c in reader.analog_labels] if analog_used else []
+        analog_rate = reader.analog_rate
 
-        col_frames = [i for i in range(1, int(frame_no)+1)]
-        col_time = [i/frame_rate for i in range(0, int(frame_no))]
+    points_arr = points_arr[:n]
 
-        df = pd.DataFrame(frames, columns=col_tuples)
-        df.columns = pd.MultiIndex.from_tuples(df.columns)
+    # Because points are 0 instead of nan while reading
+    points_arr[points_arr == 0] = np.nan
 
-        # Because points are 0 instead of nan while reading in 115-116th line
-        df.replace(0, np.nan, inplace=True)
+    col_tuples = []
+    for c in col_names:
+        col_tuples.extend([(c, 'X'), (c, 'Y'), (c, 'Z')])
 
-        df.insert(loc=0,
-                  column='frame#',
-                  value=col_frames)
+    df = pd.DataFrame(points_arr, columns=pd.MultiIndex.from_tuples(col_tuples), copy=False)
 
-        df.insert(loc=1,
-                  column='time',
-                  value=col_time)
+    df.insert(loc=0,
+              column='frame#',
+              value=np.arange(1, n + 1))
 
-    save_filepath = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '.csv'
-    if(replace or not os.path.exists(save_filepath)):
-        df.to_csv(save_filepath, index=False)
-        print('File saved as %s_%s.csv' % (patient_id, trial_no), '\n')
+    # same dtype as i/frame_rate per frame (float32 when the reader reports a float32 rate)
+    df.insert(loc=1,
+              column='time',
+              value=np.arange(n, dtype=np.result_type(frame_rate)) / frame_rate)
+
+    if analog:
+        analog_arr = analog_arr[:n * analog_per_frame]
+        df_analog = pd.DataFrame(analog_arr, columns=analog_labels, copy=False)
+        df_analog.insert(loc=0, column='time', value=np.arange(len(df_analog)) / analog_rate)
+
+    save_filepath = file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no)
+    if(replace or not os.path.exists(save_filepath + '.csv')):
+        suffix = ''
     else:
         i = 1
-        while os.path.exists(file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '_' + str(i) + '.csv'):
+        while os.path.exists(save_filepath + '_' + str(i) + '.csv'):
             i += 1
-        df.to_csv(file_dir + '/' + patient_id + '/' + patient_id + '_' + str(trial_no) + '_' + str(i) + '.csv', index=False)
-        print('File saved as %s_%s_%s.csv' % (patient_id, trial_no, i), '\n')
+        suffix = '_' + str(i)
 
-        return df
+    write_csv_chunked(df, save_filepath + suffix + '.csv', chunksize, widen=col_tuples)
+    print('File saved as %s_%s%s.csv' % (patient_id, trial_no, suffix), '\n')
+
+    if analog:
+        write_csv_chunked(df_analog, save_filepath + suffix + '_analog.csv', chunksize)
+        print('File saved as %s_%s%s_analog.csv' % (patient_id, trial_no, suffix), '\n')
+        return df, df_analog
+
+    return df
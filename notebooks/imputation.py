@@ -0,0 +1,185 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from preprocessing import knn_impute
+from trial_store import load_table, read_table, write_table
+
+'''
+Missing-value handling for joint-angle tables on the request path.
+
+Trials without missing values are returned as is (no imputer is run). Besides the
+table-wide KNN of knn_impute, two time-local methods scale linearly with trial length:
+
+    local  KNN over the frames within +-window of each incomplete frame
+    gap    linear interpolation across each gap from its neighbouring frames
+
+Imputed tables are cached next to the trial as a hidden binary table
+(<sid>/.<sid>_<trial>_jnt.<method>.vgb), used while it is newer than the trial, so
+repeated requests never impute. Precompute the caches of a whole tree with:
+
+    python imputation.py <data root> [--method knn|local|gap]
+'''
+
+INDEX_COLUMNS = ['time', '#frame']
+
+def clean_columns(df):
+    # strip column names and drop unnamed/empty columns left by CSV exports
+    df = df.copy()
+    df.columns = df.columns.str.strip()
+    return df.loc[:, [c != '' and not c.startswith('Unnamed') for c in df.columns]]
+
+def missing_mask(df):
+    '''
+    Boolean (frames x columns) mask of the missing values, index columns excluded.
+    '''
+    return df.drop(columns=[c for c in INDEX_COLUMNS if c in df.columns]).isna()
+
+def _reassemble(df, values, columns):
+    # same layout as knn_impute: value columns first, then time and #frame
+    df_imputed = pd.DataFrame(values, columns=columns)
+    for col in INDEX_COLUMNS:
+        if col in df.columns:
+            df_imputed[col] = df[col].values
+    return df_imputed
+
+def gap_impute(df, data_type='jnt', max_gap=None):
+    '''
+    Fill every gap by linear interpolation between the frames around it (nearest value at
+    the edges). Gaps longer than max_gap frames are left missing.
+    '''
+    df_gap = df.drop(columns=[c for c in INDEX_COLUMNS if c in df.columns])
+    values = df_gap.to_numpy(dtype=np.float64, copy=True)
+    frames = np.arange(len(values))
+
+    for j in range(values.shape[1]):
+        x = values[:, j]
+        missing = np.isnan(x)
+        if not missing.any() or missing.all():
+            continue
+
+        fill = missing
+        if max_gap is not None:
+            # label the runs of missing frames and keep only the short ones
+            starts = np.flatnonzero(missing & ~np.r_[False, missing[:-1]])
+            ends = np.flatnonzero(missing & ~np.r_[missing[1:], False]) + 1
+            fill = np.zeros_like(missing)
+            for start, end in zip(starts, ends):
+                if end - start <= max_gap:
+                    fill[start:end] = True
+
+        x[fill] = np.interp(frames[fill], frames[~missing], x[~missing])
+
+    return _reassemble(df, values, df_gap.columns)
+
+def local_knn_impute(df, data_type='jnt', window=60, n_neighbors=5):
+    '''
+    KNN imputation (nan-euclidean distance, uniform weights, like knn_impute) restricted to
+    the frames within +-window of each incomplete frame. Values without a donor in the
+    window are filled by gap_impute.
+    '''
+    df_knn = df.drop(columns=[c for c in INDEX_COLUMNS if c in df.columns])
+    values = df_knn.to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+    imputed = values.copy()
+    nrows, ncols = values.shape
+
+    for r in np.flatnonzero(~present.all(axis=1)):
+        lo, hi = max(0, r - window), min(nrows, r + window + 1)
+        block, block_present = values[lo:hi], present[lo:hi]
+
+        common = block_present & present[r]
+        diff = np.where(common, block - np.where(present[r], values[r], 0), 0)
+        count = common.sum(axis=1)
+        dist = (diff ** 2).sum(axis=1) * ncols / np.maximum(count, 1)
+        dist[count == 0] = np.inf
+        dist[r - lo] = np.inf
+
+        for c in np.flatnonzero(~present[r]):
+            donors = np.flatnonzero(block_present[:, c] & np.isfinite(dist))
+            if donors.size:
+                nearest = donors[np.argsort(dist[donors], kind='stable')[:n_neighbors]]
+                imputed[r, c] = block[nearest, c].mean()
+
+    df_imputed = _reassemble(df, imputed, df_knn.columns)
+    if df_imputed[df_knn.columns].isna().values.any():
+        df_imputed = gap_impute(df_imputed, data_type)[df_imputed.columns]
+
+    return df_imputed
+
+METHODS = {'knn': knn_impute, 'local': local_knn_impute, 'gap': gap_impute}
+
+def impute(df, method='knn', data_type='jnt'):
+    '''
+    Impute df with one of METHODS, skipping the imputer when nothing is missing.
+    '''
+    if method not in METHODS:
+        raise ValueError('method must be one of %s, got %r' % (list(METHODS), method))
+
+    mask = missing_mask(df)
+    if not mask.values.any():
+        columns = list(mask.columns)
+        return _reassemble(df, df[columns].to_numpy(dtype=np.float64), columns)
+
+    return METHODS[method](df, data_type=data_type)
+
+def imputed_path(csv_path, method):
+    directory, file = os.path.split(csv_path)
+    return os.path.join(directory, '.%s.%s.vgb' % (os.path.splitext(file)[0], method))
+
+def _source_mtime(csv_path):
+    # the trial CSV or its binary copy, whichever was written last
+    paths = [csv_path, os.path.splitext(csv_path)[0] + '.vgb']
+    return max(os.path.getmtime(p) for p in paths if os.path.exists(p))
+
+def load_imputed(csv_path, method='knn', data_type='jnt'):
+    '''
+    Read a trial table with its missing values imputed, from the cache when it is up to date.
+    '''
+    cache_path = imputed_path(csv_path, method)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= _source_mtime(csv_path):
+        return read_table(cache_path)
+
+    df = clean_columns(load_table(csv_path))
+    if not missing_mask(df).values.any():
+        return impute(df, method, data_type)
+
+    df = impute(df, method, data_type)
+    try:
+        write_table(df, cache_path)
+    except OSError:
+        # read-only data trees still work, they just impute on every call
+        pass
+
+    return df
+
+def impute_tree(root, method='knn'):
+    '''
+    Write the imputed-table cache of every joint-angle CSV under root that has missing values.
+    '''
+    imputed, clean = 0, 0
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+
+        for file in filenames:
+            if not file.endswith('_jnt.csv') or file.startswith('.'):
+                continue
+
+            csv_path = os.path.join(dirpath, file)
+            load_imputed(csv_path, method)
+            if os.path.exists(imputed_path(csv_path, method)):
+                imputed += 1
+            else:
+                clean += 1
+
+    print('Imputed %d trial(s), %d without missing values' % (imputed, clean), '\n')
+
+    return imputed, clean
+
+if __name__ == '__main__':
+    # python imputation.py <data root> [--method knn|local|gap]
+    args = sys.argv[1:]
+    method = args[args.index('--method') + 1] if '--method' in args else 'knn'
+    impute_tree(args[0], method)
@@ -0,0 +1,101 @@
+import os
+import threading
+import pandas as pd
+
+'''
+In-memory index of step files (<sid>step.csv) and demographic tables (demographic.csv).
+
+Each table is parsed once and kept as dictionaries keyed by (subject, trial, trialtype),
+(subject, trial) and subject id, so per-trial lookups are O(1). An entry is re-read
+when its file's mtime changes.
+'''
+
+_tables = {}
+_lock = threading.Lock()
+
+def _mtime(path):
+    return os.stat(path).st_mtime_ns
+
+def _index_step_file(path):
+    df = pd.read_csv(path, dtype={'subject': str, 'trialtype': str})
+    df.columns = df.columns.str.strip()
+
+    touch_cols = [c for c in df.columns if 'touch' in c]
+    off_cols = [c for c in df.columns if 'off' in c]
+
+    by_type, by_trial = {}, {}
+    for row in df.to_dict(orient='records'):
+        row['touch_downs'] = [row[c] for c in touch_cols]
+        row['toe_offs'] = [row[c] for c in off_cols]
+
+        subject, trial = str(row['subject']), int(row['trial'])
+        # first occurrence wins, like the boolean-mask lookups it replaces
+        by_type.setdefault((subject, trial, row.get('trialtype')), row)
+        by_trial.setdefault((subject, trial), row)
+
+    return {'by_type': by_type, 'by_trial': by_trial}
+
+def _index_demographic(path):
+    df = pd.read_csv(path, dtype={'id': str})
+    df.columns = df.columns.str.strip()
+
+    index = {}
+    for row in df.to_dict(orient='records'):
+        index.setdefault(str(row['id']), row)
+
+    return index
+
+def _get(path, build):
+    path = os.path.abspath(path)
+    mtime = _mtime(path)
+
+    entry = _tables.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+
+    with _lock:
+        entry = _tables.get(path)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, build(path))
+            _tables[path] = entry
+
+    return entry[1]
+
+def get_step(step_path, subject, trial, trialtype=None):
+    '''
+    Return the step-time row of a trial as a dict, or None if the trial is not in the file.
+    '''
+    index = _get(step_path, _index_step_file)
+    if trialtype is None:
+        return index['by_trial'].get((str(subject), int(trial)))
+
+    return index['by_type'].get((str(subject), int(trial), trialtype))
+
+def get_demographic(demographic_path, subject):
+    '''
+    Return the demographic row (e.g. thigh and shank lengths) of a subject as a dict.
+    '''
+    return _get(demographic_path, _index_demographic).get(str(subject))
+
+def preload(root):
+    '''
+    Index every step file and demographic table under root.
+    '''
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+
+        for file in filenames:
+            path = os.path.join(dirpath, file)
+            if file == 'demographic.csv':
+                _get(path, _index_demographic)
+                count += 1
+            elif file.endswith('step.csv'):
+                _get(path, _index_step_file)
+                count += 1
+
+    return count
+
+def clear():
+    with _lock:
+        _tables.clear()
@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from format_convert import trcToCSV, matToCSV, c3dToCSV
+from feature_extraction import motionToJointAngle, mark_step_times
+from preprocessing import filter_data, interpolate_impute, knn_impute, mice_impute, block_mice_impute, normalize_data
+from imputation import local_knn_impute, gap_impute
+from trial_store import load_table
+from cycle_store import build_cycle_store
+from utils import save
+
+'''
+Unattended batch pipeline over a whole data tree:
+
+    conversion -> motionToJointAngle -> imputation -> filter_data -> normalization
+
+Usage: python pipeline.py pipeline.json [--force] [--workers N]
+
+Every capture <sid>/<sid>_<trial>.(trc|mat|c3d) found under the root is processed.
+Like make, a stage is skipped when its output is newer than all of its inputs
+(the config file counts as an input of the processing stages). Answers that the
+interactive API asks for come from the config file:
+
+{
+    "root": "./data",
+    "workers": 8,
+    "column_map": {"LHEE": "Left heel"},
+    "impute": "knn",
+    "impute_options": {},
+    "filter": {"cutoff": 6, "order": 4},
+    "normalize": {"data_types": ["jnt", "grf"], "cycles": ["L", "R"]},
+    "step_times": {"022318xz": {"4": {"L": [[2.285, 2.9783], [3.4, 4.0833]], "R": [[2.8083, 3.5617], [3.9283, 4.7083]], "trialtype": "walk"}}},
+    "binary": false,
+    "cycle_store": false
+}
+
+Without "column_map", marker names are fuzzy matched and a trial is skipped
+when a marker cannot be matched confidently. "impute" is one of knn, mice,
+interpolate, local, gap, block_mice or null, and "impute_options" are passed to
+the imputer as keyword arguments (e.g. {"max_iter": 10} for block_mice). Only local
+(window, n_neighbors), gap (max_gap) and block_mice (n_predictors, related, max_iter,
+tol, workers) take options; other options are rejected when the config is loaded.
+"filter"/"normalize" can be null to skip the stage.
+With "cycle_store" set, the normalized-cycle matrices read by the server are
+brought up to date once every trial has been processed.
+'''
+
+CONVERTERS = {'trc': trcToCSV, 'mat': matToCSV, 'c3d': c3dToCSV}
+IMPUTERS = {'knn': knn_impute, 'mice': mice_impute, 'interpolate': interpolate_impute, 'local': local_knn_impute, 'gap': gap_impute,
+            'block_mice': block_mice_impute}
+# keyword options each imputer accepts in "impute_options"
+IMPUTE_OPTIONS = {'knn': (), 'mice': (), 'interpolate': (), 'local': ('window', 'n_neighbors'), 'gap': ('max_gap',),
+                  'block_mice': ('n_predictors', 'related', 'max_iter', 'tol', 'workers')}
+
+DEFAULTS = {
+    'workers': 1,
+    'column_map': None,
+    'impute': 'knn',
+    'impute_options': {},
+    'filter': {'cutoff': 6, 'order': 4},
+    'normalize': {'data_types': ['jnt', 'grf'], 'cycles': ['L', 'R']},
+    'step_times': {},
+    'binary': False,
+    'cycle_store': False,
+}
+
+CAPTURE = re.compile(r'^(?P<sid>[^_]+)_(?P<trial>\d+)\.(?P<ext>trc|mat|c3d)$', re.IGNORECASE)
+
+def load_config(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    config = dict(DEFAULTS, **config)
+    config['config_path'] = os.path.abspath(path)
+
+    if config['impute'] is not None and config['impute'] not in IMPUTERS:
+        raise ValueError('impute must be one of %s or null' % list(IMPUTERS))
+    if config['impute'] is not None:
+        unknown = sorted(set(config['impute_options'] or {}) - set(IMPUTE_OPTIONS[config['impute']]))
+        if unknown:
+            raise ValueError('impute_options %s do not apply to %s imputation (it takes %s)'
+                             % (unknown, config['impute'], list(IMPUTE_OPTIONS[config['impute']]) or 'no options'))
+
+    return config
+
+def find_captures(root):
+    captures = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for file in sorted(filenames):
+            match = CAPTURE.match(file)
+            if match and os.path.basename(dirpath) == match.group('sid'):
+                captures.append((os.path.dirname(dirpath), match.group('sid'), int(match.group('trial')), match.group('ext').lower()))
+
+    return captures
+
+def is_stale(output, inputs, force=False):
+    if force or not os.path.exists(output):
+        return True
+
+    mtime = os.path.getmtime(output)
+    return any(os.path.getmtime(i) > mtime for i in inputs if os.path.exists(i))
+
+def run_trial(file_dir, sid, trial, ext, config, force=False):
+    '''
+    Run every stale stage of one capture. Returns a list of (stage, status) tuples.
+    '''
+    base = '%s/%s/%s_%s' % (file_dir, sid, sid, trial)
+    step_file = '%s/%s/%sstep.csv' % (file_dir, sid, sid)
+    config_path = config['config_path']
+    done = []
+
+    # 1. conversion
+    if is_stale(base + '.csv', [base + '.' + ext], force):
+        CONVERTERS[ext](file_dir, sid, trial, replace=True)
+        force = True
+        done.append(('convert', 'done'))
+    else:
+        done.append(('convert', 'up to date'))
+
+    # 2. joint angles, imputation and filtering
+    if is_stale(base + '_jnt.csv', [base + '.csv', config_path], force):
+        df = motionToJointAngle(load_table(base + '.csv'), rename_cols=config['column_map'], interactive=False)
+        if df is None:
+            done.append(('jnt', 'skipped: markers could not be matched'))
+            return done
+
+        if config['impute'] is not None:
+            df = IMPUTERS[config['impute']](df, data_type='jnt', **(config['impute_options'] or {}))
+        if config['filter'] is not None:
+            df = filter_data(df, data_type='jnt', **config['filter'])
+
+        save(df, file_dir, sid, trial, data_type='jnt', replace=True, binary=config['binary'])
+        force = True
+        done.append(('jnt', 'done'))
+    else:
+        done.append(('jnt', 'up to date'))
+
+    # 3. normalization
+    if config['normalize'] is None:
+        return done
+    if not os.path.exists(step_file):
+        done.append(('normalize', 'skipped: no step file'))
+        return done
+
+    df_step = pd.read_csv(step_file)
+    if df_step[df_step['trial'] == trial].empty:
+        done.append(('normalize', 'skipped: trial not in step file'))
+        return done
+
+    for data_type in config['normalize']['data_types']:
+        source = '%s_%s.csv' % (base, data_type)
+        if not os.path.exists(source):
+            continue
+
+        for cycle in config['normalize']['cycles']:
+            output = '%s_%s_cyc_%s.csv' % (base, data_type, cycle)
+            if not is_stale(output, [source, step_file, config_path], force):
+                done.append(('normalize %s %s' % (data_type, cycle), 'up to date'))
+                continue
+
+            df = normalize_data(load_table(source), df_step, sid, trial, data_type=data_type, cycle=cycle)
+            save(df, file_dir, sid, trial, data_type=data_type, norm=True, cycle=cycle, replace=True, binary=config['binary'])
+            done.append(('normalize %s %s' % (data_type, cycle), 'done'))
+
+    return done
+
+def write_step_times(config, captures):
+    # step files are shared by all trials of a subject, so they are written before fanning out
+    dirs = {(sid, trial): file_dir for file_dir, sid, trial, _ in captures}
+
+    for sid, trials in config['step_times'].items():
+        stale = {}
+        for trial in trials:
+            file_dir = dirs.get((sid, int(trial)))
+            if file_dir is not None:
+                stale[trial] = is_stale('%s/%s/%sstep.csv' % (file_dir, sid, sid), [config['config_path']])
+
+        for trial, steps in trials.items():
+            if not stale.get(trial):
+                continue
+
+            file_dir = dirs[(sid, int(trial))]
+            L = [tuple(s) for s in steps['L']]
+            R = [tuple(s) for s in steps['R']]
+            mark_step_times(file_dir, sid, int(trial), L, R, steps.get('trialtype', 'walk'), overwrite=True)
+
+def _run_trial_safe(file_dir, sid, trial, ext, config, force):
+    try:
+        return run_trial(file_dir, sid, trial, ext, config, force)
+    except Exception:
+        return [('error', traceback.format_exc())]
+
+def run_pipeline(config, force=False, workers=None):
+    '''
+    Run the pipeline over every capture under config['root'] and return {(sid, trial): stages}.
+    '''
+    workers = workers or config['workers']
+    captures = find_captures(config['root'])
+    write_step_times(config, captures)
+    results = {}
+
+    if workers <= 1:
+        for capture in captures:
+            results[capture[1:3]] = _run_trial_safe(*capture, config, force)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {capture[1:3]: pool.submit(_run_trial_safe, *capture, config, force) for capture in captures}
+            for key, future in futures.items():
+                results[key] = future.result()
+
+    for (sid, trial), stages in results.items():
+        for stage, status in stages:
+            print('{:<12} {:<4} {:<20} {}'.format(sid, trial, stage, status))
+
+    if config['cycle_store']:
+        build_cycle_store(config['root'])
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the VIGMA processing pipeline over a data tree.')
+    parser.add_argument('config', help='JSON pipeline configuration')
+    parser.add_argument('--force', action='store_true', help='rebuild every stage regardless of timestamps')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    run_pipeline(load_config(args.config), force=args.force, workers=args.workers)
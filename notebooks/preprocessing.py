@@ -1,39 +1,72 @@
 import os
+import time
+from functools import lru_cache
 import numpy as np
-from scipy.signal import butter, filtfilt
-from sklearn import linear_model
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer, KNNImputer
 import pandas as pd
-from scipy.interpolate import interp1d
+from resample import resample_frame
+from cycle_store import trim_cycle
+
+# SciPy, scikit-learn and joblib are imported by the functions that use them, so
+# importing this module (e.g. from the server) does not load them up front
 
 ''' filtering '''
 
-def filter_signal(x, t, cutoff, order):
-    
-    valid_indices = ~np.isnan(x)
-    x_valid = x[valid_indices]
-    t_valid = t[valid_indices]
-    
-    fs = 1 / (t_valid[1] - t_valid[0])  # Sampling frequency
-    nyq = 0.5 * fs
-    b, a = butter(order, cutoff/nyq, btype='low')
-    xf_valid = filtfilt(b, a, x_valid)
-    
-    # Create a full length output array filled with nan
-    xf_full = np.full_like(x, np.nan)
-    xf_full[valid_indices] = xf_valid
-    
-    return xf_full
+@lru_cache(maxsize=64)
+def lowpass_sos(fs, cutoff, order):
+    # Butterworth low-pass in second-order sections, designed once per (fs, cutoff, order)
+    from scipy.signal import butter
+    return butter(order, cutoff/(0.5*fs), btype='low', output='sos')
+
+def sos_padlen(sos):
+    # the default edge padding of sosfiltfilt (equal to filtfilt's 3*len(b) for a Butterworth)
+    return 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+
+def filter_block(values, t, cutoff, order):
+    '''
+    Zero-phase low-pass filter of the (frames x columns) array values sampled at times t.
+    Columns with the same missing-value mask are filtered together, and every run of
+    valid frames is filtered on its own, so gaps stay missing and are never bridged.
+    '''
+    from scipy.signal import sosfiltfilt
+
+    valid = ~np.isnan(values)
+    filtered = np.full_like(values, np.nan)
+
+    groups = {}
+    for j in range(values.shape[1]):
+        groups.setdefault(valid[:, j].tobytes(), []).append(j)
+
+    for cols in groups.values():
+        mask = valid[:, cols[0]]
+        frames = np.flatnonzero(mask)
+        # frame spacing within runs of valid frames; a gap between them is not a sampling step
+        steps = np.diff(t)[mask[:-1] & mask[1:]]
+        if len(steps) == 0:
+            filtered[frames[:, None], cols] = values[frames[:, None], cols]
+            continue
+
+        sos = lowpass_sos(1 / np.median(steps), cutoff, order)
+        padlen = sos_padlen(sos)
+
+        # contiguous runs of valid frames
+        edges = np.diff(np.r_[0, mask.astype(np.int8), 0])
+        for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            segment = values[start:end][:, cols]
+            if end - start < 2:
+                filtered[start:end, cols] = segment
+            else:
+                filtered[start:end, cols] = sosfiltfilt(sos, segment, axis=0, padlen=min(padlen, end - start - 1))
+
+    return filtered
 
 def filter_data(df, data_type='jnt', cutoff=6, order=4):
 
-    if('#frame' in df.columns): df_filter = df.drop(columns=['#frame'])
+    df_filter = df.drop(columns=['#frame']) if '#frame' in df.columns else df.copy()
     df_filter = df_filter.astype(float)
     df_filter.set_index('time', inplace=True)
 
-    df_filter = df_filter.apply(lambda x: filter_signal(
-        x.to_numpy(), x.index.to_numpy(), cutoff, order), axis=0)
+    df_filter = pd.DataFrame(filter_block(df_filter.to_numpy(), df_filter.index.to_numpy(), cutoff, order),
+                             index=df_filter.index, columns=df_filter.columns)
 
     df_filter = df_filter.reset_index()
     if('#frame' in df.columns): df_filter['#frame'] = df['#frame']
@@ -54,6 +87,7 @@ def interpolate_impute(df, data_type='jnt'):
     return df_interpolate
 
 def knn_impute(df, data_type = 'jnt'):
+    from sklearn.impute import KNNImputer
 
     columns = ['time', '#frame']
     existing_columns_to_drop = [col for col in columns if col in df.columns]
@@ -71,6 +105,9 @@ def knn_impute(df, data_type = 'jnt'):
     return df_knn_imputed
 
 def mice_impute(df, data_type='jnt'):
+    from sklearn import linear_model
+    from sklearn.experimental import enable_iterative_imputer
+    from sklearn.impute import IterativeImputer
 
     columns = ['time', '#frame']
     existing_columns_to_drop = [col for col in columns if col in df.columns]
@@ -89,43 +126,91 @@ def mice_impute(df, data_type='jnt'):
 
     return df_mice_imputed
 
-''' normalize data '''
+# predictors tried first for each joint-angle column: adjacent segments of the same leg,
+# the same segment of the other leg, and the trunk for the thighs
+JNT_RELATED = {
+    'Lfoot': ['Lshank', 'Rfoot'],
+    'Rfoot': ['Rshank', 'Lfoot'],
+    'Lshank': ['Lfoot', 'Lthigh', 'Rshank'],
+    'Rshank': ['Rfoot', 'Rthigh', 'Lshank'],
+    'Lthigh': ['Lshank', 'Rthigh', 'trunk'],
+    'Rthigh': ['Rshank', 'Lthigh', 'trunk'],
+    'trunk': ['Lthigh', 'Rthigh', 'hipx'],
+    'hipx': ['trunk'],
+}
+
+def mice_block(values, max_iter, tol):
+    # MICE over one target column (first) and its predictors
+    from sklearn import linear_model
+    from sklearn.experimental import enable_iterative_imputer
+    from sklearn.impute import IterativeImputer
+
+    start = time.perf_counter()
+    mice_imputer = IterativeImputer(estimator=linear_model.BayesianRidge(
+    ), imputation_order='ascending', max_iter=max_iter, tol=tol)
+    imputed = mice_imputer.fit_transform(values)
 
-def interpolate_data(df, min_points):
-    indices = np.arange(len(df))
-    interpolated_data = pd.DataFrame()
+    return imputed[:, 0], mice_imputer.n_iter_, time.perf_counter() - start
 
-    cols = df.columns.tolist()
+def block_mice_impute(df, data_type='jnt', n_predictors=4, related=None, max_iter=10, tol=1e-3, workers=1, report=False):
+    '''
+    MICE with bounded cost: each column with missing values is imputed from at most
+    n_predictors columns (anatomically related ones first, then the most correlated),
+    with early stopping at tol. Columns are independent blocks, imputed in parallel
+    over workers processes. With report=True, returns (df, report) where report has
+    the predictors, iteration count and seconds of every imputed column.
+    '''
+    from joblib import Parallel, delayed
+
+    columns = ['time', '#frame']
+    existing_columns_to_drop = [col for col in columns if col in df.columns]
 
-    for col in cols:
-        if(col != 'time'):
-            interpolation_function = interp1d(indices, df[col], kind='linear')
-            interpolated_indices = np.linspace(0, len(df) - 1, min_points)
-            interpolated_data[col] = interpolation_function(interpolated_indices)
+    df_mice = df.drop(columns=existing_columns_to_drop).astype(float)
+    if related is None:
+        related = JNT_RELATED if data_type == 'jnt' else {}
+
+    observed = [c for c in df_mice.columns if df_mice[c].notna().any()]
+    targets = [c for c in observed if df_mice[c].isna().any()]
+    corr = df_mice[observed].corr().abs()
+
+    blocks = []
+    for col in targets:
+        predictors = [c for c in related.get(col, []) if c in observed and c != col][:n_predictors]
+        for c in corr[col].drop(col).dropna().sort_values(ascending=False, kind='stable').index:
+            if len(predictors) >= n_predictors:
+                break
+            if c not in predictors:
+                predictors.append(c)
+        blocks.append((col, predictors))
+
+    results = Parallel(n_jobs=workers)(
+        delayed(mice_block)(df_mice[[col] + predictors].to_numpy(), max_iter, tol) for col, predictors in blocks)
+
+    df_mice_imputed = df_mice.reset_index(drop=True)
+    rows = []
+    for (col, predictors), (values, n_iter, seconds) in zip(blocks, results):
+        rows.append({'column': col, 'missing': int(df_mice_imputed[col].isna().sum()), 'predictors': predictors,
+                     'n_iter': n_iter, 'seconds': seconds})
+        df_mice_imputed[col] = values
 
-    t = np.linspace(0, 100, len(interpolated_data))
-    interpolated_data['time'] = t
+    for col in columns:
+        if col in df.columns:
+            df_mice_imputed[col] = df[col].values
 
-    cols = interpolated_data.columns.tolist()
-    cols = cols[-1:] + cols[:-1]
-    interpolated_data = interpolated_data[cols]
-    
-    return interpolated_data
+    if report:
+        return df_mice_imputed, pd.DataFrame(rows, columns=['column', 'missing', 'predictors', 'n_iter', 'seconds'])
+    return df_mice_imputed
 
-def normalize_data(df, df_step, patient_id, trial, data_type='jnt', cycle = 'L'):
-    def normalize(data, data_step):
-        if(data_step['footing'].values[0] == 'L'):
-            if(cycle == 'L'): df = data[(data['time'] >= data_step['touch down'].values[0]) & (data['time'] <= data_step['touch down.2'].values[0])]
-            else: df = data[(data['time'] >= data_step['touch down.1'].values[0]) & (data['time'] <= data_step['touch down.3'].values[0])]
-        else:
-            if(cycle == 'L'): df = data[(data['time'] >= data_step['touch down.1'].values[0]) & (data['time'] <= data_step['touch down.3'].values[0])]
-            else: df = data[(data['time'] >= data_step['touch down'].values[0]) & (data['time'] <= data_step['touch down.2'].values[0])]
+''' normalize data '''
 
-        return df
+def interpolate_data(df, min_points, kind='linear'):
+    # every column but 'time' resampled to min_points; 'time' becomes 0-100 (% of cycle)
+    return resample_frame(df, min_points, kind)
 
+def normalize_data(df, df_step, patient_id, trial, data_type='jnt', cycle = 'L', kind = 'linear'):
     df_step = df_step[(df_step['trial'] == int(trial)) & (df_step['subject'] == patient_id)]
 
-    data = normalize(df, df_step)
-    data = interpolate_data(data, 100)
+    data = trim_cycle(df, df_step.iloc[0], cycle)
+    data = interpolate_data(data, 100, kind)
 
     return data
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+'''
+Resampling of trial tables to a fixed number of points (e.g. 100 per gait cycle).
+
+Samples are treated as equally spaced (their frame index), like the interp1d-based
+interpolate_data this replaces; 'linear' reproduces interp1d(kind='linear') exactly and
+'cubic' is the same not-a-knot spline as interp1d(kind='cubic'). A whole
+(frames x columns) block is resampled at once, and resample_batch handles many
+trials of different lengths in one vectorized pass.
+'''
+
+KINDS = ('linear', 'cubic')
+
+def interp_columns(x, xp, fp):
+    '''
+    np.interp(x, xp, fp[:, j]) for every column j of the 2-D array fp in one pass.
+    Follows np.interp exactly, including its handling of exact hits and NaN samples.
+    '''
+
+    x = np.asarray(x, dtype=float)
+    xp = np.asarray(xp, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+
+    j = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    x_col = x[:, None]
+    fp_lo, fp_hi = fp[j], fp[j + 1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (fp_hi - fp_lo) / (xp[j + 1] - xp[j])[:, None]
+        res = slope * (x_col - xp[j][:, None]) + fp_lo
+
+        # if we get nan in one direction, try the other
+        nan = np.isnan(res)
+        res[nan] = (slope * (x_col - xp[j + 1][:, None]) + fp_hi)[nan]
+        nan = np.isnan(res) & (fp_lo == fp_hi)
+        res[nan] = fp_lo[nan]
+
+    exact = (x == xp[j])[:, None]
+    res = np.where(exact, fp_lo, res)
+    res[x <= xp[0]] = fp[0]
+    res[x >= xp[-1]] = fp[-1]
+
+    return res
+
+def resample(values, n_points=100, kind='linear'):
+    '''
+    Resample a (frames,) or (frames x columns) array to n_points rows.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if kind not in KINDS:
+        raise ValueError('kind must be one of %s, got %r' % (KINDS, kind))
+    if len(values) < 2:
+        raise ValueError('at least 2 frames are needed to resample, got %d' % len(values))
+
+    frames = np.arange(len(values), dtype=np.float64)
+    x_new = np.linspace(0, len(values) - 1, n_points)
+
+    if kind == 'cubic':
+        from scipy.interpolate import make_interp_spline
+        return make_interp_spline(frames, values, k=3, axis=0)(x_new)
+
+    if values.ndim == 1:
+        return interp_columns(x_new, frames, values[:, None])[:, 0]
+    return interp_columns(x_new, frames, values)
+
+def resample_batch(blocks, n_points=100, kind='linear'):
+    '''
+    Resample a list of (frames_i x columns) arrays (e.g. the cycles of many trials) to one
+    (trials x n_points x columns) array. Linear resampling is a single gather over all
+    trials, with the same results as resample() on each block.
+    '''
+    blocks = [np.asarray(b, dtype=np.float64).reshape(len(b), -1) for b in blocks]
+    if not blocks:
+        return np.empty((0, n_points, 0))
+    if kind != 'linear':
+        return np.stack([resample(b, n_points, kind) for b in blocks])
+
+    lengths = np.array([len(b) for b in blocks])
+    if lengths.min() < 2:
+        raise ValueError('at least 2 frames are needed to resample, got %d' % lengths.min())
+
+    stacked = np.concatenate(blocks)
+    offsets = np.r_[0, np.cumsum(lengths)[:-1]][:, None]
+    last = (lengths - 1)[:, None]
+
+    # per trial: linspace(0, length - 1, n_points) and the frame below each point
+    x_new = np.linspace(np.zeros(len(blocks)), lengths - 1, n_points, axis=1)
+    j = np.minimum(np.floor(x_new).astype(np.intp), last - 1)
+    x = x_new[..., None]
+    fp_lo, fp_hi = stacked[j + offsets], stacked[j + 1 + offsets]
+
+    # np.interp on the frame index (frame spacing is 1)
+    with np.errstate(invalid='ignore'):
+        slope = (fp_hi - fp_lo) / 1.0
+        res = slope * (x - j[..., None]) + fp_lo
+
+        nan = np.isnan(res)
+        res[nan] = (slope * (x - (j + 1)[..., None]) + fp_hi)[nan]
+        nan = np.isnan(res) & (fp_lo == fp_hi)
+        res[nan] = fp_lo[nan]
+
+    res = np.where((x_new == j)[..., None], fp_lo, res)
+    res = np.where((x_new >= last)[..., None], stacked[(last + offsets)[:, 0]][:, None, :], res)
+    res[:, 0] = stacked[offsets[:, 0]]
+
+    return res
+
+def resample_frame(df, n_points=100, kind='linear'):
+    '''
+    Resample every column of df except 'time' to n_points rows; 'time' becomes 0-100 (% of cycle).
+    '''
+    cols = [col for col in df.columns if col != 'time']
+    values = resample(df[cols].to_numpy(dtype=np.float64), n_points, kind)
+
+    df_resampled = pd.DataFrame(values, columns=cols)
+    df_resampled.insert(0, 'time', np.linspace(0, 100, n_points))
+
+    return df_resampled
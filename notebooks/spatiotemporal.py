@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import pandas as pd
+
+from imputation import load_imputed
+from trial_store import atomic_write
+from metadata import get_step, get_demographic
+
+'''
+Batch spatiotemporal parameters (STP) of the trials of a subject.
+
+The step table and segment lengths of a subject are read once, only the frames the
+parameters need are gathered from each trial's (imputed) joint angles, and step
+lengths, swing/gait times and gait speed are computed as array operations over all
+trials. Results are kept in <group>/<sid>/<sid>sptmp.csv (the layout written by
+save(..., data_type='sptmp_params')) and reused while that file is newer than the
+trials' joint angles, the step file and demographic.csv. The file holds parameters of
+KNN-imputed trials (as get_sptmp_params always did); other imputation methods are
+computed without it.
+'''
+
+STP_COLUMNS = ['sid', 'trial', 'RstepLength', 'LstepLength', 'timeRswing', 'timeLswing', 'timeRgait', 'timeLgait', 'GaitSpeed']
+
+# joint angles are sampled at 120 Hz
+FRAME_RATE = 120
+
+def sptmp_path(group_dir, sid):
+    return os.path.join(group_dir, sid, '%ssptmp.csv' % sid)
+
+def _inputs(group_dir, sid, trials):
+    paths = [os.path.join(group_dir, 'demographic.csv'), os.path.join(group_dir, sid, '%sstep.csv' % sid)]
+    for trial in trials:
+        jnt = os.path.join(group_dir, sid, '%s_%s_jnt.csv' % (sid, trial))
+        paths += [jnt, os.path.splitext(jnt)[0] + '.vgb']
+    return [p for p in paths if os.path.exists(p)]
+
+def compute_stp(group_dir, sid, trials, impute_method='knn'):
+    '''
+    Compute the STP of the given trials of one subject. Returns a DataFrame with STP_COLUMNS.
+    '''
+    trials = [int(trial) for trial in trials]
+    dem = get_demographic(os.path.join(group_dir, 'demographic.csv'), sid)
+    thigh = dem['thigh']
+    shank = dem['shank']
+
+    steps = [get_step(os.path.join(group_dir, sid, '%sstep.csv' % sid), sid, trial) for trial in trials]
+    missing = [trial for trial, sts in zip(trials, steps) if sts is None]
+    if missing:
+        raise KeyError('no step times for %s trial(s) %s' % (sid, missing))
+
+    first_L = np.array([sts['footing'] == 'L' for sts in steps])
+    TDs = np.array([sts['touch_downs'][:4] for sts in steps], dtype=np.float64)
+    LOs = np.array([sts['toe_offs'][:2] for sts in steps], dtype=np.float64)
+
+    timeswing1 = LOs[:, 1] - TDs[:, 1]
+    timeswing2 = LOs[:, 0] - TDs[:, 0]
+    timegait1 = TDs[:, 3] - TDs[:, 1]
+    timegait2 = TDs[:, 2] - TDs[:, 0]
+
+    timeRswing = np.where(first_L, timeswing1, timeswing2)
+    timeLswing = np.where(first_L, timeswing2, timeswing1)
+    timeRgait = np.where(first_L, timegait1, timegait2)
+    timeLgait = np.where(first_L, timegait2, timegait1)
+
+    # frames of the first three touch downs
+    TD = np.array([[int(round(t*FRAME_RATE)) for t in td[:3]] for td in TDs], dtype=np.intp).reshape(-1, 3)
+
+    # (trials x 2 touch downs x [Rthigh, Rshank, Lthigh, Lshank]) angles in radians
+    angles = np.empty((len(trials), 2, 4))
+    GaitSpeed = np.empty(len(trials))
+    for i, trial in enumerate(trials):
+        jnts = load_imputed(os.path.join(group_dir, sid, '%s_%d_jnt.csv' % (sid, trial)), method=impute_method)
+        block = jnts[['Rthigh', 'Rshank', 'Lthigh', 'Lshank']].to_numpy(dtype=np.float64)
+        angles[i] = block[TD[i, :2]]/180*np.pi
+
+        hipx = jnts['hipx'].to_numpy(dtype=np.float64)
+        GaitSpeed[i] = np.mean((np.diff(hipx)*FRAME_RATE)[TD[i, 0]-1:TD[i, 2]])
+
+    cos = np.cos(angles)
+    Rthigh, Rshank, Lthigh, Lshank = cos[..., 0], cos[..., 1], cos[..., 2], cos[..., 3]
+
+    # the right step ends at the second touch down when the left foot lands first
+    r = np.where(first_L, 1, 0)
+    l = 1 - r
+    rows = np.arange(len(trials))
+    RstepLength = -Rthigh[rows, r]*thigh - Rshank[rows, r]*shank + Lthigh[rows, r]*thigh + Lshank[rows, r]*shank
+    LstepLength = Rthigh[rows, l]*thigh + Rshank[rows, l]*shank - Lthigh[rows, l]*thigh - Lshank[rows, l]*shank
+
+    return pd.DataFrame({'sid': sid, 'trial': np.array(trials, dtype=np.int64),
+                         'RstepLength': RstepLength, 'LstepLength': LstepLength,
+                         'timeRswing': timeRswing, 'timeLswing': timeLswing,
+                         'timeRgait': timeRgait, 'timeLgait': timeLgait,
+                         'GaitSpeed': GaitSpeed}, columns=STP_COLUMNS)
+
+def read_stp(group_dir, sid, trials):
+    '''
+    Return the stored STP rows of trials (in that order) if <sid>sptmp.csv is up to date, else None.
+    '''
+    path = sptmp_path(group_dir, sid)
+    if not os.path.exists(path):
+        return None
+
+    mtime = os.path.getmtime(path)
+    if any(os.path.getmtime(p) > mtime for p in _inputs(group_dir, sid, trials)):
+        return None
+
+    df = pd.read_csv(path, dtype={'sid': str}, float_precision='round_trip')
+    if list(df.columns) != STP_COLUMNS:
+        return None
+
+    df = df.drop_duplicates('trial').set_index('trial', drop=False)
+    trials = [int(trial) for trial in trials]
+    if not all(trial in df.index for trial in trials):
+        return None
+
+    return df.loc[trials].reset_index(drop=True)
+
+def get_stp(group_dir, sid, trials, impute_method='knn', persist=True):
+    '''
+    STP of the given trials of a subject, read from <sid>sptmp.csv when it is up to date.
+    Otherwise the trials are computed in one batch and merged into the file.
+    '''
+    persist = persist and impute_method == 'knn'
+    if persist:
+        df = read_stp(group_dir, sid, trials)
+        if df is not None:
+            return df
+
+    df = compute_stp(group_dir, sid, trials, impute_method)
+
+    if persist:
+        # keep rows of other trials that are still up to date
+        path = sptmp_path(group_dir, sid)
+        stored = None
+        if os.path.exists(path):
+            stored = pd.read_csv(path, dtype={'sid': str}, float_precision='round_trip')
+            if list(stored.columns) == STP_COLUMNS:
+                stored = stored[~stored['trial'].isin(df['trial'])]
+                stored = read_stp(group_dir, sid, stored['trial'].tolist()) if len(stored) else None
+            else:
+                stored = None
+
+        table = pd.concat([stored, df]) if stored is not None else df
+        table = table.sort_values('trial', kind='stable')
+
+        try:
+            with atomic_write(path, 'w') as f:
+                table.to_csv(f, index=False)
+        except OSError:
+            # read-only data trees are recomputed on every call
+            pass
+
+    return df
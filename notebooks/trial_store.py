@@ -0,0 +1,175 @@
+import json
+import os
+import struct
+import sys
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+'''
+Columnar binary storage for trial tables (motion, jnt, grf, normalized cycles).
+
+A .vgb file sits next to the CSV it mirrors (041602jb_1_jnt.csv -> 041602jb_1_jnt.vgb):
+
+    b'VGB1' | uint32 header length | JSON header | padding to 64 bytes | float64 data
+
+The data block is column-major, so np.memmap can hand out a single column
+(e.g. 'Rshank') by touching only that column's bytes. CSVs stay the source of
+truth for back-compat; a .vgb is used only while it is at least as new as its CSV.
+'''
+
+MAGIC = b'VGB1'
+ALIGN = 64
+EXT = '.vgb'
+
+def table_path(csv_path):
+    return os.path.splitext(csv_path)[0] + EXT
+
+def is_fresh(csv_path):
+    bin_path = table_path(csv_path)
+    if not os.path.exists(bin_path):
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    return os.path.getmtime(bin_path) >= os.path.getmtime(csv_path)
+
+def read_motion_csv(path):
+    # motion CSVs carry a two-row (marker, axis) header
+    df = pd.read_csv(path, header=None)
+
+    columns = df.iloc[:2]
+    df = df.iloc[2:]
+    columns = columns.fillna('')
+
+    columns = pd.MultiIndex.from_arrays(columns.values.tolist())
+    df.columns = columns
+
+    # header=None reads the data rows as text
+    return df.apply(pd.to_numeric)
+
+def is_motion_csv(path):
+    with open(path, 'r') as f:
+        first = f.readline().split(',')[0].strip()
+    return first == 'frame#'
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    # write to a private temp file next to path and move it over path when the block
+    # succeeds, so concurrent writers never share a temp file and readers never see a
+    # partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, newline=None if 'b' in mode else '') as f:
+            yield f
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def write_table(df, path):
+    multiindex = isinstance(df.columns, pd.MultiIndex)
+    columns = [list(c) for c in df.columns] if multiindex else [str(c) for c in df.columns]
+    numeric = [pd.to_numeric(df.iloc[:, j]) for j in range(df.shape[1])]
+    values = [col.to_numpy(dtype='<f8') for col in numeric]
+    # integer columns (e.g. '#frame') are stored as float64 and restored on read
+    int_columns = [j for j, col in enumerate(numeric) if pd.api.types.is_integer_dtype(col.dtype)]
+
+    header = json.dumps({'columns': columns, 'multiindex': multiindex, 'nrows': len(df), 'dtype': '<f8', 'int_columns': int_columns}).encode('utf-8')
+    offset = len(MAGIC) + 4 + len(header)
+    padding = (-offset) % ALIGN
+
+    with atomic_write(path) as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(b' ' * padding)
+        for col in values:
+            col.tofile(f)
+
+    return path
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a VGB trial table' % path)
+        (length,) = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length).decode('utf-8'))
+
+    offset = len(MAGIC) + 4 + length
+    header['offset'] = offset + (-offset) % ALIGN
+
+    return header
+
+def read_table(path, columns=None):
+    header = read_header(path)
+    names = [tuple(c) for c in header['columns']] if header['multiindex'] else header['columns']
+    nrows, ncols = header['nrows'], len(names)
+
+    if nrows == 0 or ncols == 0:
+        data = np.empty((nrows, ncols))
+    else:
+        data = np.memmap(path, dtype=header['dtype'], mode='r', offset=header['offset'], shape=(nrows, ncols), order='F')
+
+    idx = list(range(ncols))
+    if columns is not None:
+        idx = [names.index(tuple(c) if header['multiindex'] else c) for c in columns]
+        names = [names[i] for i in idx]
+        data = data[:, idx]
+
+    df = pd.DataFrame(np.array(data), columns=pd.MultiIndex.from_tuples(names) if header['multiindex'] else names)
+
+    int_columns = set(header.get('int_columns', []))
+    for j, i in enumerate(idx):
+        if i in int_columns:
+            df.isetitem(j, df.iloc[:, j].astype('int64'))
+
+    return df
+
+def load_table(csv_path, columns=None):
+    '''
+    Read a trial table, preferring its binary copy when it is up to date.
+    '''
+    if is_fresh(csv_path):
+        return read_table(table_path(csv_path), columns)
+
+    df = read_motion_csv(csv_path) if is_motion_csv(csv_path) else pd.read_csv(csv_path)
+    return df[columns] if columns is not None else df
+
+def convert_tree(root, replace=False):
+    '''
+    Write a .vgb next to every numeric trial CSV under root. CSVs are left in place.
+    Step, spatiotemporal and demographic tables are skipped.
+    '''
+    converted, skipped = 0, 0
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+
+        for file in filenames:
+            if not file.endswith('.csv') or file.endswith(('step.csv', 'sptmp.csv')) or file == 'demographic.csv':
+                continue
+
+            csv_path = os.path.join(dirpath, file)
+            if not replace and is_fresh(csv_path):
+                continue
+
+            try:
+                df = read_motion_csv(csv_path) if is_motion_csv(csv_path) else pd.read_csv(csv_path)
+                write_table(df, table_path(csv_path))
+                converted += 1
+            except (ValueError, TypeError):
+                skipped += 1
+
+    print('Converted %d file(s), skipped %d non-numeric file(s)' % (converted, skipped), '\n')
+
+    return converted, skipped
+
+if __name__ == '__main__':
+    # python trial_store.py <data root> [--replace]
+    convert_tree(sys.argv[1], replace='--replace' in sys.argv[2:])
@@ -2,6 +2,7 @@ import pandas as pd
 import os
 import plotly.graph_objects as go
 import shutil
+from trial_store import is_fresh, read_motion_csv, read_table, table_path, write_table
 
 def remove_empty_columns(df):
     df = df.loc[:, ~df.columns.str.contains(
@@ -12,7 +13,7 @@ def remove_empty_columns(df):
 
     return df
 
-def save(df, file_dir, patient_id, trial = None, data_type = 'jnt', norm = False, cycle = 'L', replace = False):
+def save(df, file_dir, patient_id, trial = None, data_type = 'jnt', norm = False, cycle = 'L', replace = False, binary = False):
 
     if(norm == True):
         save_path = '%s/%s/%s_%s_%s_cyc_%s' % (file_dir, patient_id, patient_id, trial, data_type, cycle)
@@ -31,15 +32,21 @@ def save(df, file_dir, patient_id, trial = None, data_type = 'jnt', norm = False
         relative_path = '%s_%s_%s' % (patient_id, trial, data_type)
 
     if(replace or not os.path.exists(save_path+'.csv')):
-        df.to_csv(save_path+'.csv', index=False)
+        csv_path = save_path + '.csv'
+        df.to_csv(csv_path, index=False)
         print('File saved as %s.csv' % (relative_path), '\n')
 
     else:
         i = 1
         while os.path.exists(save_path + '(' + str(i) + ')' + '.csv'):
             i += 1
-        df.to_csv(save_path + '(' + str(i) + ')'  + '.csv', index=False)
+        csv_path = save_path + '(' + str(i) + ')'  + '.csv'
+        df.to_csv(csv_path, index=False)
         print('File saved as %s(%s).csv' % (relative_path, i), '\n')
+
+    # step and spatiotemporal tables hold strings and stay CSV only
+    if(binary and data_type not in ('sptmp_params', 'step_time')):
+        write_table(df, table_path(csv_path))
     
     return
 
@@ -47,7 +54,7 @@ def read(file_dir, patient_id, trial = None, data_type = 'jnt', norm = False, cy
     # jnt/grf/motion/stp_params/step_file/normalized_jnt or grf
     
     if(data_type == 'motion'): path = '%s/%s/%s_%s' % (file_dir, patient_id, patient_id, trial)
-    elif(data_type == 'sptmp_params'): path = '%s/%s/%s_sptmp' % (file_dir, patient_id, patient_id)
+    elif(data_type == 'sptmp_params'): path = '%s/%s/%ssptmp' % (file_dir, patient_id, patient_id)
     elif(data_type == 'step_time'): path = '%s/%s/%sstep' % (file_dir, patient_id, patient_id)
     elif(norm == True): path = '%s/%s/%s_%s_%s_cyc_%s' % (file_dir, patient_id, patient_id, trial, data_type, cycle)
     else: path = '%s/%s/%s_%s_%s' % (file_dir, patient_id, patient_id, trial, data_type)
@@ -57,15 +64,12 @@ def read(file_dir, patient_id, trial = None, data_type = 'jnt', norm = False, cy
     
     path = path + '.csv'
     
-    if(data_type == 'motion'):
-        df = pd.read_csv(path, header=None)
-
-        columns = df.iloc[:2]
-        df = df.iloc[2:]
-        columns = columns.fillna('')
+    if(data_type not in ('sptmp_params', 'step_time') and is_fresh(path)):
+        df = read_table(table_path(path))
+        if(data_type != 'motion'): df = remove_empty_columns(df)
 
-        columns = pd.MultiIndex.from_arrays(columns.values.tolist())
-        df.columns = columns
+    elif(data_type == 'motion'):
+        df = read_motion_csv(path)
 
     else:
         df = pd.read_csv(path)
@@ -217,7 +221,7 @@ def plot(df, data_type='jnt', steps = False, cycle=False, **kwargs):
 
     return
 
-def load_VA(file_dir, patient_id, data_type, trial = None, group='misc', norm = False, cycle = 'L'):
+def load_VA(file_dir, patient_id, data_type, trial = None, group='misc', norm = False, cycle = 'L', overwrite = None):
 
     # first check if ../backend/data/group exists. if not, create it
     if(not os.path.exists("../backend/data/%s" % group)):
@@ -245,9 +249,10 @@ def load_VA(file_dir, patient_id, data_type, trial = None, group='misc', norm =
 
     # first check if the file exists in the VA path
     if(os.path.exists(save_path + '/' + file)):
-        print('File %s already exists. Do you want to overwrite (y/n)?' % (file), '\n')
-        response = input()
-        if(response == 'n'):
+        if(overwrite is None):
+            print('File %s already exists. Do you want to overwrite (y/n)?' % (file), '\n')
+            overwrite = input() != 'n'
+        if(not overwrite):
             print('File %s not overwritten in VA system' % (file), '\n')
             return
         else: